@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
+#
+#   The variance of the physical distances per unit of the fractions between the neighbor
+#   loci of one genmap output on stdin; evaluation.py scores many maps at once
+#
 import sys
 import statistics
 
-lines = sys.stdin.read().splitlines()
-chroms = [x.split()[0] for x in lines]
+import numpy as np
 
-distance_estimations = [float(x.split()[1]) for x in lines[:-1]]
-positions = [int(x.strip('chrA1.')) for x in chroms]
+import genfile
+import evaluation
+
+m = evaluation.parse_maps(sys.stdin.read().splitlines(), "-")[0]
+chroms = sum(m.groups, [])
+distance_estimations = np.concatenate(m.fractions)[:-1].tolist()
+positions = [genfile.locus_position(x)[1] for x in chroms]
 distances = [a - b for a, b in zip(positions, positions[1:])]
 
 assert len(distances) == len(distance_estimations)
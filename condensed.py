@@ -0,0 +1,263 @@
+'''
+    Symmetric matrices over the pairs of loci, kept condensed
+
+    Only the upper triangle is stored, row by row like the condensed distance
+    matrices of scipy: of the M * (M - 1) / 2 values, the pair (i, j), i < j, is at
+
+        M * i - i * (i + 1) / 2 + j - i - 1
+
+    and the diagonal is kept on its own. The matrix reads like a square numpy array
+    without ever making one: m[i] is a row, m[a:b] a block of rows, m[rows, columns]
+    the values at the broadcast index arrays, m[i][j] works as for the list matrices.
+    np.asarray(m) gives the whole square when it is really needed
+
+    BandedMatrix reads the same way, but keeps only the pairs of the loci within
+    a width of each other in an approximate order of them, M * (width + 1) values;
+    all the other pairs read as its fill value. The reading is the one of PairMatrix,
+    the base of both, which only needs the values of the pairs
+'''
+import numpy as np
+
+
+def condensed_size(M):
+    return M * (M - 1) // 2
+
+# position of the pairs (i, j), i < j, among the values
+def condensed_index(M, i, j):
+    i = np.asarray(i, dtype=np.int64)
+    return M * i - i * (i + 1) // 2 + j - i - 1
+
+
+#
+#   The reading of a symmetric matrix over the loci as the square, from its pair(i, j),
+#   the values at the pairs of the broadcast index arrays, and its size M. The rows are
+#   read by _rows, the subclasses with a faster way than pair() to them replace it; the
+#   ones that keep their values add and OR them with the same layout in _combine
+#
+class PairMatrix(object):
+    @property
+    def shape(self):
+        return (self.M, self.M)
+
+    def __len__(self):
+        return self.M
+
+    # the rows of the loci, an index array of any shape
+    def _rows(self, loci):
+        return self.pair(loci[..., None], np.arange(self.M))
+
+    def rows(self, start, stop):
+        return self._rows(np.arange(start, min(stop, self.M)))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.pair(*key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.M)
+            if step != 1:
+                raise IndexError("only the row blocks with the step 1")
+            return self.rows(start, stop)
+        return self._rows(np.asarray(key))
+
+    def __iter__(self):
+        for i in range(self.M):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        square = self.rows(0, self.M)
+        return square if dtype is None else square.astype(dtype)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+    def __add__(self, other):
+        return self._combine(other, np.add)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    # the matrix of op on the values of self and other
+    def _combine(self, other, op):
+        raise TypeError("%s keeps no values to combine" % type(self).__name__)
+
+
+class SymmetricMatrix(PairMatrix):
+    def __init__(self, M, values=None, diagonal=None, dtype=np.float64):
+        self.M = M
+        self.values = np.zeros(condensed_size(M), dtype=dtype) if values is None else values
+        self.diagonal = np.zeros(M, dtype=self.values.dtype) if diagonal is None else diagonal
+
+    @classmethod
+    def from_square(cls, square):
+        square = np.asarray(square)
+        i, j = np.triu_indices(len(square), 1)
+        return cls(len(square), square[i, j], square.diagonal().copy())
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    #
+    #   Add the (len(loci) x len(loci)) square, symmetric, to the pairs of the loci,
+    #   a scalar is added to all of them. The loci must be distinct
+    #
+    def add(self, loci, square):
+        loci = np.asarray(loci, dtype=np.int64)
+        square = np.broadcast_to(square, (len(loci), len(loci)))
+        upper = loci[:, None] < loci[None, :]
+        positions = condensed_index(self.M, loci[:, None], loci[None, :])
+        self.values[positions[upper]] += square[upper]
+        self.diagonal[loci] += square.diagonal()
+
+    # add the values at the distinct pairs (i, j), i <= j
+    def add_pairs(self, i, j, values):
+        i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+        values = np.broadcast_to(values, i.shape)
+        on_diagonal = i == j
+        self.diagonal[i[on_diagonal]] += values[on_diagonal]
+        off = ~on_diagonal
+        self.values[condensed_index(self.M, i[off], j[off])] += values[off]
+
+    # the matrix of the pairs of the loci alone, numbered 0 .. len(loci) - 1 in their order
+    def submatrix(self, loci):
+        loci = np.asarray(loci, dtype=np.int64)
+        n = len(loci)
+        values = np.empty(condensed_size(n), dtype=self.dtype)
+        for r in range(n - 1):
+            start = int(condensed_index(n, r, r + 1))
+            values[start:start + n - r - 1] = self.pair(loci[r], loci[r + 1:])
+        return SymmetricMatrix(n, values, self.diagonal[loci].copy())
+
+    # the values at the pairs of the broadcast index arrays
+    def pair(self, i, j):
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+        low, high = np.minimum(i, j), np.maximum(i, j)
+        out = np.empty(low.shape, dtype=self.dtype)
+        on_diagonal = low == high
+        out[on_diagonal] = self.diagonal[low[on_diagonal]]
+        off = ~on_diagonal
+        out[off] = self.values[condensed_index(self.M, low[off], high[off])]
+        return out[()]
+
+    def _combine(self, other, op):
+        return SymmetricMatrix(self.M, op(self.values, other.values), op(self.diagonal, other.diagonal))
+
+
+#
+#   The values of the pairs within width of each other in the order (a permutation of the
+#   loci), values[r, d] is the pair (order[r], order[r + d]); the pairs outside the band
+#   read as fill
+#
+class BandedMatrix(PairMatrix):
+    def __init__(self, order, width, values=None, fill=0, dtype=np.float64):
+        self.order = np.asarray(order, dtype=np.int64)
+        self.M = len(self.order)
+        self.width = width
+        self.rank = np.empty(self.M, dtype=np.int64)
+        self.rank[self.order] = np.arange(self.M)
+        self.values = np.zeros((self.M, width + 1), dtype=dtype) if values is None else values
+        self.fill = fill
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    # (row, column) of the pairs in values and whether they are in the band
+    def _cells(self, i, j):
+        ri, rj = self.rank[i], self.rank[j]
+        low, distance = np.minimum(ri, rj), np.abs(ri - rj)
+        inside = distance <= self.width
+        return low[inside], distance[inside], inside
+
+    # add the values at the distinct pairs (i, j), the ones outside the band are left out
+    def add_pairs(self, i, j, values):
+        i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+        values = np.broadcast_to(values, i.shape)
+        low, distance, inside = self._cells(i, j)
+        self.values[low, distance] += values[inside]
+
+    # the values at the pairs of the broadcast index arrays
+    def pair(self, i, j):
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+        out = np.full(i.shape, self.fill, dtype=self.dtype)
+        low, distance, inside = self._cells(i, j)
+        out[inside] = self.values[low, distance]
+        return out[()]
+
+    # the rows of the loci, fill but the 2 * width + 1 values of the band around every locus
+    def _rows(self, loci):
+        flat = np.asarray(loci, dtype=np.int64).ravel()
+        out = np.full((len(flat), self.M), self.fill, dtype=self.dtype)
+        rank, rows = self.rank[flat], np.arange(len(flat))
+        for d in range(self.width + 1):
+            up, down = rank + d < self.M, rank >= d
+            out[rows[up], self.order[rank[up] + d]] = self.values[rank[up], d]
+            out[rows[down], self.order[rank[down] - d]] = self.values[rank[down] - d, d]
+        return out.reshape(np.shape(loci) + (self.M,))
+
+    #
+    #   The band of the pairs of the loci alone, numbered 0 .. len(loci) - 1 in their order,
+    #   the loci in the order of this band. Their distances in it are at most the ones here,
+    #   so the same width keeps all the pairs of the loci that are in this band
+    #
+    def submatrix(self, loci):
+        loci = np.asarray(loci, dtype=np.int64)
+        n = len(loci)
+        order = np.argsort(self.rank[loci], kind="mergesort")
+        r, d = np.nonzero(np.arange(n)[:, None] + np.arange(self.width + 1)[None, :] < n)
+        values = np.zeros((n, self.width + 1), dtype=self.dtype)
+        values[r, d] = self.pair(loci[order[r]], loci[order[r + d]])
+        return BandedMatrix(order, self.width, values, self.fill)
+
+    #
+    #   The k smallest values of every row: (index, values) (M x k), the equal values in
+    #   the order of the loci, like the sorted rows of the square. They come from the
+    #   2 * width + 1 loci of the band around every locus; a row whose k-th value is not
+    #   below fill may have loci out of the band among them, it is sorted whole
+    #
+    def nearest(self, k):
+        M, width = self.M, self.width
+        ranks = np.arange(M)[:, None] + np.arange(-width, width + 1)[None, :]
+        valid = (ranks >= 0) & (ranks < M)
+        partners = np.where(valid, self.order[np.clip(ranks, 0, M - 1)], M)
+        values = np.where(valid, self.pair(self.order[:, None], np.minimum(partners, M - 1)), np.inf)
+        rows = np.arange(M)[:, None]
+        by_locus = np.argsort(partners, axis=1, kind="mergesort")
+        partners, values = partners[rows, by_locus], values[rows, by_locus]
+        by_value = np.argsort(values, axis=1, kind="mergesort")[:, :k]
+        partners, values = partners[rows, by_value], values[rows, by_value]
+        # a band narrower than k leaves the rest of the rows to the whole sort
+        index = np.zeros((M, k), dtype=np.int32)
+        nearest = np.full((M, k), np.inf)
+        index[self.order, :partners.shape[1]] = partners
+        nearest[self.order, :values.shape[1]] = values
+        for locus in np.flatnonzero(~(nearest[:, -1] < self.fill)) if k else ():
+            row = self.pair(locus, np.arange(M))
+            index[locus] = np.argsort(row, kind="mergesort")[:k]
+            nearest[locus] = row[index[locus]]
+        return index, nearest
+
+    #
+    #   The rows as dicts of the pairs in the band, reading fill for the others:
+    #   the fastest lookup of one pair at a time, in O(M * width)
+    #
+    def lookup(self):
+        r, d = np.nonzero(np.arange(self.M)[:, None] + np.arange(self.width + 1)[None, :] < self.M)
+        a, b = self.order[r], self.order[r + d]
+        v = self.values[r, d].tolist()
+        rows = [_BandRow(self.fill) for _ in range(self.M)]
+        for (x, y, value) in zip(a.tolist(), b.tolist(), v):
+            rows[x][y] = rows[y][x] = value
+        return rows
+
+    def _combine(self, other, op):
+        return BandedMatrix(self.order, self.width, op(self.values, other.values), self.fill)
+
+
+class _BandRow(dict):
+    def __init__(self, fill):
+        dict.__init__(self)
+        self.fill = fill
+
+    def __missing__(self, key):
+        return self.fill
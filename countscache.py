@@ -0,0 +1,128 @@
+'''
+    Disk cache of the cis/trans counts of genmap
+
+    The counts of a pedigree are kept under a key made from what they depend on:
+    the genotypes and the parents of the organisms, stat, order_hint, the phasing
+    of the gametes and COUNTS_VERSION. A renamed or copied file finds its counts,
+    a changed one does not. The entries are files of the binary pedigree layout
+    (genfile.write_binary), the condensed counts in the smallest unsigned type
+    that holds them. Using an entry touches it; when the cache grows over its
+    size, the entries used longest ago go first.
+
+        cache = CountsCache()
+        key = counts_key(pedigree, stat)
+        counts = cache.get(key)
+        if counts is None:
+            counts = pedigree.count_cistrans(pedigree.parent_rows(), stat)
+            cache.put(key, counts)
+'''
+import os
+import hashlib
+
+import numpy as np
+
+import genfile
+from condensed import SymmetricMatrix
+
+# change it when the same pedigree gets other counts, the old entries are not used then
+COUNTS_VERSION = 1
+SUFFIX = ".counts"
+DEFAULT_SIZE = 1 << 30
+NAMES = ("rec", "nonrec", "defined")
+
+
+def default_directory():
+    return os.environ.get("GENMAP_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "genmap")
+
+#
+#   The key of the counts of the pedigree, a hex sha1
+#
+def counts_key(pedigree, stat=True, order_hint=None):
+    digest = hashlib.sha1()
+    options = (COUNTS_VERSION, bool(stat), order_hint and list(order_hint), pedigree.phasing, pedigree.M)
+    digest.update(repr(options).encode("utf-8"))
+    for array in (pedigree.parents, pedigree.genotypes):
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)).encode("utf-8"))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def _compact(values):
+    if values.dtype == bool or not values.size:
+        return values
+    return values.astype(np.min_scalar_type(max(0, int(values.max()))))
+
+
+class CountsCache(object):
+    def __init__(self, directory=None, max_bytes=DEFAULT_SIZE):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    # the (rec, nonrec, defined) SymmetricMatrix's of the key, None if they are not there
+    def get(self, key):
+        path = self.path(key)
+        try:
+            header, columns = genfile.read_binary(path, genfile.COUNTS_MAGIC)
+            counts = tuple(SymmetricMatrix(header["M"],
+                                           columns[name + "_values"].astype(dtype),
+                                           columns[name + "_diagonal"].astype(dtype))
+                           for (name, dtype) in zip(NAMES, (np.int64, np.int64, bool)))
+            # the time of the last use, for the eviction
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None             # not there, or a broken entry
+        return counts
+
+    def put(self, key, counts):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        columns = {}
+        for (name, matrix) in zip(NAMES, counts):
+            columns[name + "_values"] = _compact(matrix.values)
+            columns[name + "_diagonal"] = _compact(matrix.diagonal)
+        genfile.write_binary(self.path(key), counts[0].M, [], columns,
+                             magic=genfile.COUNTS_MAGIC, extra={"key": key})
+        self.evict()
+
+    # (time of the last use, size, path) of the entries, the oldest first
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue        # removed by another process
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    # remove the entries used longest ago until the cache fits in max_bytes
+    def evict(self):
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        for (_, entry_size, path) in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        for (_, _, path) in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''
+    Quality of the maps genmap.py printed, against the true order of the loci
+
+    usage: evaluation.py [--truth FILE] [--tsv] MAP ...
+
+    A MAP is a file with the output of genmap.py, of genmap.py batch (the maps
+    of all its "# FILE" sections) or a directory of such files, like
+    testing/results; the output of time at the end of a file is read as the
+    run time. The true order is the one of --truth, the "NAME [POSITION]" lines
+    pedigree_generator.py --true-order writes, or by default the one of the
+    positions at the end of the locus names (genfile.locus_position).
+
+    Every map gets a row of the table:
+          loci     - the loci of the map with a true position
+          groups   - its linkage groups, the orders between the empty lines
+          tau      - Kendall tau of the map against the true order
+          rho      - Spearman rho of the same
+          breaks   - the neighbor loci of the map not neighbors in the true order
+          path     - the sum of the fractions of the map between the neighbor loci
+          corr     - the correlation of those fractions with the true distances
+          seconds  - the run time, when the file has it
+    tau and rho count the pairs of loci within the groups only, each group in its
+    better orientation; the neighbors in the true order are the ones among the
+    loci of the map. A directory of several maps gets a row of the means too.
+'''
+from __future__ import print_function, division
+
+import os
+import re
+import sys
+import argparse
+import collections
+
+import numpy as np
+
+import genfile
+
+#
+#   A map: the names of the loci of every group and the fractions to the next
+#   locus, NaN for the last one of a group or the ones printed without it
+#
+Map = collections.namedtuple("Map", ["name", "groups", "fractions", "seconds"])
+
+COLUMNS = ["loci", "groups", "tau", "rho", "breaks", "path", "corr", "seconds"]
+TIME_LINE = re.compile(r"(real|user|sys)\s+(?:(\d+)m)?([\d.]+)s\Z")
+
+
+def _map(name, groups, fractions, seconds):
+    groups, fractions = [g for g in groups if g], [np.array(f) for f in fractions if f]
+    return Map(name, groups, fractions, seconds)
+
+#
+#   The maps of the lines of genmap.py output, one per "# FILE" section of genmap.py
+#   batch, or one named name
+#
+def parse_maps(lines, name):
+    maps = []
+    groups, fractions, seconds = [[]], [[]], float("nan")
+    for line in lines:
+        line = line.strip()
+        timed = TIME_LINE.match(line)
+        if line.startswith("#"):
+            if any(groups):
+                maps.append(_map(name, groups, fractions, seconds))
+            name = line[1:].strip()
+            groups, fractions, seconds = [[]], [[]], float("nan")
+        elif timed:
+            if timed.group(1) == "real":
+                seconds = 60 * int(timed.group(2) or 0) + float(timed.group(3))
+        elif not line:
+            groups.append([])
+            fractions.append([])
+        else:
+            fields = line.split()
+            groups[-1].append(fields[0])
+            fractions[-1].append(float(fields[1]) if len(fields) > 1 else float("nan"))
+    if any(groups) or not maps:
+        maps.append(_map(name, groups, fractions, seconds))
+    return maps
+
+# the maps of a file, the ones of every file of a directory in the order of the names
+def read_maps(path):
+    if os.path.isdir(path):
+        return [m for name in sorted(os.listdir(path)) if not name.startswith(".")
+                for m in read_maps(os.path.join(path, name))]
+    with open(path) as f:
+        return parse_maps(f, path)
+
+#
+#   The true rank, chromosome and position of every locus name, from the lines of a
+#   --truth file or from the names themselves
+#
+class Truth(object):
+    def __init__(self, names, chromosomes, positions):
+        self.rank = dict((name, r) for (r, name) in enumerate(names))
+        self.chromosome = np.asarray(chromosomes)
+        self.position = np.asarray(positions, dtype=np.float64)
+
+    @classmethod
+    def from_file(cls, path):
+        names, positions = [], []
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    names.append(fields[0])
+                    positions.append(float(fields[1]) if len(fields) > 1 else len(positions))
+        return cls(names, np.zeros(len(names), dtype=np.int64), positions)
+
+    @classmethod
+    def from_names(cls, names):
+        # the chromosomes in the order of their first loci
+        chromosomes = {}
+        keys = {}
+        for name in names:
+            if name not in keys:
+                chromosome, position = genfile.locus_position(name)
+                keys[name] = (chromosomes.setdefault(chromosome, len(chromosomes)), position, name)
+        keys = sorted(keys.values())
+        return cls([k[2] for k in keys], [k[0] for k in keys], [k[1] for k in keys])
+
+    # the ranks of the names, -1 for the ones without a true position
+    def ranks(self, names):
+        return np.array([self.rank.get(name, -1) for name in names], dtype=np.int64)
+
+#
+#   The pairs i < j with x[i] > x[j], block_rows rows of the comparisons at a time
+#
+def inversions(x, block_rows=1024):
+    x = np.asarray(x)
+    count = 0
+    for start in range(0, len(x), block_rows):
+        block = x[start:start + block_rows]
+        later = np.arange(start, start + len(block))[:, None] < np.arange(len(x))[None, :]
+        count += int(np.count_nonzero(later & (block[:, None] > x[None, :])))
+    return count
+
+#
+#   The table row of a map: the metrics of COLUMNS
+#
+def evaluate(m, truth):
+    concordant = pairs = rhos = weight = 0.0
+    breaks = 0
+    steps, distances = [], []
+    groups = [truth.ranks(group) for group in m.groups]
+    placed = np.concatenate([g[g >= 0] for g in groups]) if groups else np.zeros(0, dtype=np.int64)
+    # the ranks among the loci of the map
+    dense = np.zeros(len(truth.rank) + 1, dtype=np.int64)
+    dense[np.sort(placed)] = np.arange(len(placed))
+    for (ranks, fractions) in zip(groups, m.fractions):
+        known = ranks >= 0
+        x = dense[ranks[known]]
+        n = len(x)
+        if n > 1:
+            total = n * (n - 1) / 2.0
+            concordant += abs(total - 2 * inversions(x))
+            pairs += total
+            d = np.argsort(np.argsort(x)) - np.arange(n)
+            # the reversed group has -rho
+            rhos += n * abs(1 - 6.0 * np.sum(d * d) / (n * (n * n - 1)))
+            weight += n
+            breaks += int(np.count_nonzero(np.abs(np.diff(x)) != 1))
+        # the steps between the neighbors of the map both with a true position
+        a, b = ranks[:-1], ranks[1:]
+        step = fractions[:-1]
+        same = (a >= 0) & (b >= 0) & ~np.isnan(step)
+        same[same] = truth.chromosome[a[same]] == truth.chromosome[b[same]]
+        steps.append(step[same])
+        distances.append(np.abs(truth.position[a[same]] - truth.position[b[same]]))
+    steps = np.concatenate(steps) if steps else np.zeros(0)
+    distances = np.concatenate(distances) if distances else np.zeros(0)
+    corr = float("nan")
+    if len(steps) > 1 and steps.std() > 0 and distances.std() > 0:
+        corr = float(np.corrcoef(steps, distances)[0, 1])
+    return {"loci": len(placed), "groups": len(m.groups),
+            "tau": concordant / pairs if pairs else float("nan"),
+            "rho": rhos / weight if weight else float("nan"),
+            "breaks": breaks, "path": float(np.nansum(np.concatenate(m.fractions))) if m.fractions else 0.0,
+            "corr": corr, "seconds": m.seconds}
+
+#
+#   The rows (name, metrics) of the maps of the paths, with the means of the directories
+#   of more than one map after their maps
+#
+def summary(paths, truth=None):
+    sources = [(path, read_maps(path)) for path in paths]
+    if truth is None:
+        truth = Truth.from_names([name for (_, maps) in sources for m in maps
+                                  for group in m.groups for name in group])
+    rows = []
+    for (path, maps) in sources:
+        scored = [(m.name, evaluate(m, truth)) for m in maps]
+        rows.extend(scored)
+        if os.path.isdir(path) and len(scored) > 1:
+            means = dict((c, float(np.nanmean([s[c] for (_, s) in scored]))
+                          if not all(np.isnan(s[c]) for (_, s) in scored) else float("nan"))
+                         for c in COLUMNS)
+            rows.append(("%s (mean of %d)" % (path, len(scored)), means))
+    return rows
+
+
+def format_rows(rows, tsv=False):
+    formats = {"loci": "%d", "groups": "%d", "breaks": "%d", "tau": "%.4f", "rho": "%.4f",
+               "path": "%.4f", "corr": "%.4f", "seconds": "%.3f"}
+
+    def cell(column, value):
+        if isinstance(value, float) and np.isnan(value):
+            return "-"
+        if isinstance(value, float) and formats[column] == "%d" and value != int(value):
+            return "%.1f" % value
+        return formats[column] % value
+
+    table = [["map"] + COLUMNS] + [[name] + [cell(c, s[c]) for c in COLUMNS] for (name, s) in rows]
+    if tsv:
+        return ["\t".join(row) for row in table]
+    width = max(len(row[0]) for row in table)
+    return [row[0].ljust(width) + "".join("%10s" % x for x in row[1:]) for row in table]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Score the maps against the true order of the loci")
+    parser.add_argument("maps", nargs="+", metavar="MAP",
+                        help="genmap.py output files, or directories of them")
+    parser.add_argument("--truth", metavar="FILE",
+                        help="the true order, NAME [POSITION] lines; by default the positions in the names")
+    parser.add_argument("--tsv", action="store_true", help="tab separated values instead of the table")
+    args = parser.parse_args(argv)
+    truth = Truth.from_file(args.truth) if args.truth else None
+    for line in format_rows(summary(args.maps, truth), args.tsv):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
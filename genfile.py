@@ -0,0 +1,415 @@
+'''
+    Reading of the .GEN pedigree files
+
+    The file is read in big blocks (plain or gzip compressed), and the allel
+    lines are converted to numbers in bulk, straight into the preallocated
+    genotype matrix.
+'''
+import os
+import re
+import sys
+import mmap
+import json
+import gzip
+import zlib
+import hashlib
+import collections
+
+import numpy as np
+
+BLOCK_SIZE = 1 << 22            # bytes read from the file at once
+BATCH_LINES = 4096              # allel lines converted together
+
+GZIP_MAGIC = b"\x1f\x8b"
+BINARY_MAGIC = b"GENMAPB1"
+INDEX_MAGIC = b"GENMAPK1"       # the same layout, the nearest-locus index of genmap
+COUNTS_MAGIC = b"GENMAPC1"      # and the cached cis/trans counts of genmap
+BINARY_ALIGN = 64
+INT_LINE = re.compile(br"-?\d+(?:\s+-?\d+)*\Z")
+LOCUS_POSITION = re.compile(r"(.*?)\.?(\d+)\Z")
+
+#
+#   The whole pedigree as arrays, one row per organism
+#         ids - int64, parents - int64 (organisms x 2) ids of the parents, 0 if unknown,
+#         sexes - int8, genotypes - int8 (organisms x 2M)
+#
+GenData = collections.namedtuple("GenData",
+    ["M", "locs_names", "ids", "parents", "sexes", "genotypes"])
+
+#
+#   The chromosome and the position at the end of a locus name: "chrA1.238505217"
+#   is at 238505217 of chrA1, "L12" at 12 of L
+#
+def locus_position(name):
+    match = LOCUS_POSITION.match(name)
+    if match is None:
+        raise ValueError("no position in the locus name %r" % (name,))
+    return match.group(1), int(match.group(2))
+
+
+class GenFormatError(ValueError):
+    def __init__(self, message, name=None, line=None, column=None):
+        self.message = message
+        self.name = name
+        self.line = line
+        self.column = column
+        ValueError.__init__(self, str(self))
+
+    def __str__(self):
+        where = [str(x) for x in (self.name, self.line, self.column) if x is not None]
+        return ":".join(where + [" " + self.message]) if where else self.message
+
+
+def _text(b):
+    return b if isinstance(b, str) else b.decode("utf-8")
+
+#
+#   source is None (stdin), a path or a binary file object
+#
+def is_path(source):
+    return isinstance(source, (str, bytes, type(u""))) or hasattr(source, "__fspath__")
+
+
+def _open(source):
+    if source is None:
+        return getattr(sys.stdin, "buffer", sys.stdin), "<stdin>", False
+    if is_path(source):
+        return open(source, "rb"), _text(str(source)), True
+    return source, getattr(source, "name", "<stream>"), False
+
+#
+#   Blocks of the file, gunzipped on the fly if the file starts with the gzip magic
+#
+def read_blocks(f, block_size=BLOCK_SIZE, digest=None):
+    def read():
+        block = f.read(block_size)
+        if digest is not None:
+            digest.update(block)
+        return block
+
+    block = read()
+    if not block.startswith(GZIP_MAGIC):
+        while block:
+            yield block
+            block = read()
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while block:
+        data = decompressor.decompress(block)
+        while decompressor.unused_data:         # the next gzip member
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(rest)
+        if data:
+            yield data
+        block = read()
+    data = decompressor.flush()
+    if data:
+        yield data
+
+#
+#   The not empty lines of every block, stripped, with their line numbers
+#
+def not_empty_lines(blocks):
+    lineno = 0
+    tail = b""
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        stripped = [line.strip() for line in lines]
+        yield ([lineno + 1 + i for (i, line) in enumerate(stripped) if line],
+               [line for line in stripped if line])
+        lineno += len(lines)
+    tail = tail.strip()
+    if tail:
+        yield [lineno + 1], [tail]
+
+
+class _Parser(object):
+    def __init__(self, name, blocks):
+        self.name = name
+        self.blocks = blocks
+        self.numbers = []
+        self.lines = []
+        self.position = 0
+        self.lineno = 0
+
+    def error(self, message, line=None, column=None):
+        return GenFormatError(message, self.name, line or self.lineno, column)
+
+    # up to count following lines
+    def take(self, count):
+        numbers, lines = [], []
+        while len(lines) < count:
+            if self.position == len(self.lines):
+                try:
+                    self.numbers, self.lines = next(self.blocks)
+                except StopIteration:
+                    break
+                self.position = 0
+                continue
+            stop = self.position + count - len(lines)
+            numbers += self.numbers[self.position:stop]
+            lines += self.lines[self.position:stop]
+            self.position = min(stop, len(self.lines))
+        if numbers:
+            self.lineno = numbers[-1]
+        return numbers, lines
+
+    def next_line(self, what):
+        numbers, lines = self.take(1)
+        if not lines:
+            raise self.error("unexpected end of file, expected %s" % what)
+        return lines[0]
+
+    def ints(self, line, what, count=None):
+        tokens = line.split()
+        if count is not None and len(tokens) != count:
+            raise self.error("expected %d numbers (%s), got %d" % (count, what, len(tokens)))
+        try:
+            return [int(t) for t in tokens]
+        except ValueError:
+            bad = next(t for t in tokens if not _is_int(t))
+            raise self.error("bad number %r in %s" % (_text(bad), what),
+                             column=_column(line, tokens.index(bad)))
+
+    def int_line(self, what):
+        return self.ints(self.next_line(what), what, 1)[0]
+
+    #
+    #   count numbers on each of the lines, converted together.
+    #   np.fromstring of older numpy silently stops at "1.5" or "1x", so the lines are checked too
+    #
+    def numbers_of(self, numbers, lines, count, what):
+        if all(len(line.split()) == count for line in lines):
+            joined = b" ".join(lines)
+            if INT_LINE.match(joined):
+                return np.fromstring(joined, dtype=np.int64, sep=" ").reshape(len(lines), count)
+        for (lineno, line) in zip(numbers, lines):
+            self.lineno = lineno
+            self.ints(line, what, count)
+        raise self.error("can not read %s" % what)
+
+    #
+    #   allels of many organisms at once. The usual file has one digit allels
+    #   separated by single spaces - such lines are checked and converted as bytes
+    #
+    def allels(self, numbers, lines, out, M):
+        width = 4 * M - 1
+        if all(len(line) == width for line in lines):
+            raw = np.frombuffer(b" ".join(lines), dtype=np.uint8)
+            digits = raw[0::2]
+            if (raw[1::2] == ord(" ")).all() and ((digits >= ord("0")) & (digits <= ord("9"))).all():
+                out[:] = (digits - ord("0")).reshape(out.shape)
+                return
+
+        values = self.numbers_of(numbers, lines, 2 * M, "allels")
+        wrong = (values < -128) | (values > 127)
+        if wrong.any():
+            (k, i) = np.argwhere(wrong)[0]
+            raise self.error("allel out of range", numbers[k], _column(lines[k], i))
+        out[:] = values
+
+    def parse(self):
+        self.int_line("number of families")          # not used, assumed 1
+        M = self.int_line("number of loci")
+        locs_names = [_text(x) for x in self.next_line("names of loci").split()]
+        if len(locs_names) != M:
+            raise self.error("expected %d names of loci, got %d" % (M, len(locs_names)))
+
+        self.int_line("family number")
+        n = self.int_line("number of species")
+
+        ids = np.zeros(n, dtype=np.int64)
+        parents = np.zeros((n, 2), dtype=np.int64)
+        sexes = np.zeros(n, dtype=np.int8)
+        genotypes = np.zeros((n, 2 * M), dtype=np.int8)
+
+        what = "id, parent1, parent2, sex"
+        for start in range(0, n, BATCH_LINES):       # READ FAMILY
+            stop = min(n, start + BATCH_LINES)
+            numbers, lines = self.take(2 * (stop - start))
+            if len(lines) < 2 * (stop - start):
+                raise self.error("unexpected end of file, expected %s"
+                                 % ("allels" if len(lines) % 2 else what))
+            species = self.numbers_of(numbers[0::2], lines[0::2], 4, what)
+            ids[start:stop] = species[:, 0]
+            parents[start:stop] = species[:, 1:3]
+            sexes[start:stop] = species[:, 3]
+            self.allels(numbers[1::2], lines[1::2], genotypes[start:stop], M)
+
+        return GenData(M, locs_names, ids, parents, sexes, genotypes)
+
+
+def _is_int(token):
+    try:
+        int(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _column(line, token):
+    # 1-based position of the token in the line
+    position = 0
+    for _ in range(token + 1):
+        while line[position:position + 1].isspace():
+            position += 1
+        start = position
+        while position < len(line) and not line[position:position + 1].isspace():
+            position += 1
+    return start + 1
+
+#
+#   Parse the .GEN file. source is a path, a binary file object or None for stdin;
+#   gzip compressed files are recognized by their first bytes.
+#   The raw bytes of the file also go to digest (a hashlib object), if given
+#
+def read_gen(source=None, block_size=BLOCK_SIZE, digest=None):
+    f, name, own = _open(source)
+    try:
+        return _Parser(name, not_empty_lines(read_blocks(f, block_size, digest))).parse()
+    finally:
+        if own:
+            f.close()
+
+#
+#   Write the pedigree in the .GEN format, a block of organisms at a time.
+#   dest is a path (gzip compressed if it ends with .gz) or a binary file object
+#
+def write_gen(dest, data, block_rows=BATCH_LINES):
+    if is_path(dest):
+        opener = gzip.open if _text(str(dest)).endswith(".gz") else open
+        with opener(dest, "wb") as f:
+            return write_gen(f, data, block_rows)
+
+    n = len(data.ids)
+    M = data.M
+    header = "1\n%d\n%s\n\n1\n%d\n" % (M, " ".join(data.locs_names), n)
+    dest.write(header.encode("utf-8"))
+    one_digit = not n or (data.genotypes.min() >= 0 and data.genotypes.max() <= 9)
+    for start in range(0, n, block_rows):
+        stop = min(n, start + block_rows)
+        genotypes = data.genotypes[start:stop]
+        if one_digit and M:
+            text = np.full((stop - start, 4 * M), ord(" "), dtype=np.uint8)
+            text[:, 0::2] = genotypes + ord("0")
+            text[:, -1] = ord("\n")
+            lines = [row.tobytes() for row in text]
+        else:
+            lines = [(" ".join(map(str, row)) + "\n").encode("utf-8") for row in genotypes.tolist()]
+        chunk = []
+        for (k, line) in enumerate(lines):
+            i = start + k
+            chunk.append(("%d %d %d %d\n" % (data.ids[i], data.parents[i, 0], data.parents[i, 1],
+                                             data.sexes[i])).encode("utf-8"))
+            chunk.append(line)
+        dest.write(b"".join(chunk))
+
+#
+#   The binary pedigree file:
+#         BINARY_MAGIC, the length of the header (8 bytes, little endian),
+#         the JSON header - M, names of loci, number of organisms, the source file
+#         and the place of every array - and the arrays themselves, each one
+#         aligned to BINARY_ALIGN bytes. Such a file is mapped to memory, not read.
+#   Other files of the same layout have their own magic and more in the header
+#
+def _aligned(n):
+    return (n + BINARY_ALIGN - 1) // BINARY_ALIGN * BINARY_ALIGN
+
+
+def _native(name):
+    return name if isinstance(name, str) else name.encode("utf-8")
+
+
+def write_binary(path, M, locs_names, columns, source=None, magic=BINARY_MAGIC, extra=None):
+    arrays = {}
+    offset = 0
+    for name in sorted(columns):
+        array = np.ascontiguousarray(columns[name])
+        arrays[name] = {"dtype": array.dtype.newbyteorder("<").str, "shape": list(array.shape),
+                        "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header = {"version": 1, "M": M, "organisms": len(columns.get("ids", ())),
+              "locs_names": list(locs_names), "source": source, "arrays": arrays}
+    header.update(extra or {})
+    header = json.dumps(header).encode("utf-8")
+    start = _aligned(len(magic) + 8 + len(header))
+
+    # write next to the destination and rename, so the readers never see a half written file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(magic)
+            f.write(np.array([len(header)], dtype="<u8").tobytes())
+            f.write(header)
+            for name in sorted(columns):
+                f.seek(start + arrays[name]["offset"])
+                array = np.ascontiguousarray(columns[name], dtype=arrays[name]["dtype"])
+                array.tofile(f)
+            f.truncate(start + offset)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+#
+#   (header, arrays) of the binary file; the arrays are read only views of the mapped file
+#
+def read_binary(path, magic=BINARY_MAGIC):
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise GenFormatError("not a binary pedigree file", path)
+        size = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(size).decode("utf-8"))
+        start = _aligned(len(magic) + 8 + size)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    header["locs_names"] = [_native(name) for name in header["locs_names"]]
+    columns = {}
+    for (name, a) in header["arrays"].items():
+        dtype = np.dtype(str(a["dtype"]))
+        shape = tuple(a["shape"])
+        count = int(np.prod(shape))
+        if start + a["offset"] + count * dtype.itemsize > len(data):
+            raise GenFormatError("truncated binary pedigree file", path)
+        if count:
+            columns[_native(name)] = np.frombuffer(data, dtype=dtype, count=count,
+                                                   offset=start + a["offset"]).reshape(shape)
+        else:
+            columns[_native(name)] = np.zeros(shape, dtype=dtype)
+    return header, columns
+
+#
+#   What the cache remembers about the source file: size, modification time and sha1
+#
+def source_info(path, sha1=None, st=None):
+    st = st or os.stat(path)
+    if sha1 is None:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+        sha1 = digest.hexdigest()
+    return {"size": st.st_size, "mtime": st.st_mtime, "sha1": sha1}
+
+#
+#   Whether the binary file was made from the current contents of path.
+#   The file is hashed only if its size is the same, but the time is not
+#
+def source_matches(header, path):
+    source = header.get("source")
+    if not source:
+        return False
+    st = os.stat(path)
+    if st.st_size != source["size"]:
+        return False
+    if st.st_mtime == source["mtime"]:
+        return True
+    return source_info(path)["sha1"] == source["sha1"]
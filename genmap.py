@@ -4,9 +4,23 @@
 
 
 '''
+import os
 import sys
+import hashlib
+import argparse
 import itertools
+import multiprocessing
 import collections
+import copy
+
+import numpy as np
+
+import genfile
+import profiling
+from condensed import PairMatrix, SymmetricMatrix, BandedMatrix
+from countscache import CountsCache, counts_key
+from ordering import form_cluster, insert_locus, complete_order, order_loci, ORDERING_ENGINES, NEIGHBORS
+from ordering import linkage_groups, order_groups
 
 def perr(*args):
     for x in args:
@@ -16,17 +30,72 @@ def perr(*args):
 OrganismRecord = collections.namedtuple("OrganismRecord",
     ["id", "parent1", "parent2", "sex", "allels"])
 
+#
+#   Engines for the cis/trans counting. "python" is the reference implementation,
+#   "numpy" counts all the locus pairs of a parent at once with matrix products
+#
+CISTRANS_ENGINES = ("python", "numpy")
+
+#
+#   How the gametes are revealed: "parents" from the genotypes of the parents as they are
+#   in the file, "iterative" from the genotypes imputed through the generations first
+#   (impute_genotypes), so what one generation reveals helps the next one
+#
+PHASINGS = ("parents", "iterative")
+
+#
+#   The pedigree is kept column-wise: one row per organism in the arrays
+#         genotypes     - int8 (organisms x 2M), the allels as they are in the .GEN file
+#         imputed       - the genotypes with the imputed allels for the "iterative" phasing, None otherwise
+#         gamets1/2     - int8 (organisms x M), the revealed gametes
+#         parents       - int32 (organisms x 2), row of the parents, -1 if unknown
+#         gamete_parents - int32 (organisms x 2), row of the parent each gamete came from
+#         child_ptr, child_index - int32, children of every organism in the CSR layout
+#
 class Pedigree(object):
+    #
+    #   A thin view of one row of the arrays, for the code that walks organisms one by one
+    #
     class Organism(object):
-        def __init__(self, record):
-            self.id = record.id
-            self.sex = record.sex
-            self.allels = record.allels
-            self.parents = []
-            self.children = []
+        __slots__ = ("pedigree", "index")
+
+        def __init__(self, pedigree, index):
+            self.pedigree = pedigree
+            self.index = index
+
+        @property
+        def id(self):
+            return int(self.pedigree.ids[self.index])
+
+        @property
+        def sex(self):
+            return int(self.pedigree.sexes[self.index])
+
+        @property
+        def allels(self):
+            return self.pedigree.genotypes[self.index].tolist()
+
+        @property
+        def parents(self):
+            return [Pedigree.Organism(self.pedigree, p)
+                    for p in self.pedigree.parents[self.index].tolist() if p >= 0]
+
+        @property
+        def children(self):
+            return [Pedigree.Organism(self.pedigree, ch)
+                    for ch in self.pedigree.children_of(self.index).tolist()]
+
+        @property
+        def gamets1(self):
+            return self.pedigree.gamete(self.index, 0)
+
+        @property
+        def gamets2(self):
+            return self.pedigree.gamete(self.index, 1)
 
         def is_homozigota_at(self, i):
-            return self.allels[2 * i] == self.allels[2 * i + 1]
+            allels = self.pedigree.genotypes[self.index]
+            return allels[2 * i] == allels[2 * i + 1]
 
         def __eq__(self, other):
             return isinstance(other, Pedigree.Organism) and self.id == other.id
@@ -35,292 +104,1585 @@ class Pedigree(object):
             return hash(self.id)
 
     def __init__(self, M, number_of_species, locs_names, records):
+        self._build(M, number_of_species, locs_names, *record_arrays(M, records))
+
+    #
+    #   The pedigree straight from the arrays of genfile.GenData,
+    #   parent_ids is (organisms x 2) with 0 for an unknown parent
+    #
+    @classmethod
+    def from_arrays(cls, M, locs_names, ids, parent_ids, sexes, genotypes):
+        pedigree = cls.__new__(cls)
+        pedigree._build(M, len(ids), locs_names, ids, parent_ids, sexes, genotypes)
+        return pedigree
+
+    def _build(self, M, number_of_species, locs_names, ids, parent_ids, sexes, genotypes):
         self.M = M
         self.number_of_species = number_of_species
         self.locs_names = locs_names
-        organism_by_id = {r.id: Pedigree.Organism(r) for r in records}
-        for r in records:
-            child = organism_by_id[r.id]
-            parents = [organism_by_id[p_id] for p_id in [r.parent1, r.parent2] if p_id]
-            child.parents = parents
-            for p in parents:
-                p.children.append(child)
-        self.organisms = organism_by_id.values()
+        self.ids = ids
+        self.sexes = sexes
+        self.genotypes = genotypes
+        self._id_order = np.argsort(ids, kind="mergesort")
+        self.parents = self._parent_rows(parent_ids)
+        self._link_children()
+        self.phasing = "parents"
+        self.imputed = None
         self.reveal_gametes()
 
-    def reveal_gametes(self):
-        def store_gamets(organism, g1, g2):
-            organism.gamets1 = g1
-            organism.gamets2 = g2
-
-        # cycle through all species
-        for s in self.organisms:
-            # init gametes for the specie
-            g1 = [0] * (self.M + 1)
-            g2 = [0] * (self.M + 1)
-            for i in range(self.M):
-                if s.is_homozigota_at(i):
-                    g1[i] = g2[i] = s.allels[2 * i]
-
-            if not s.parents:
-                store_gamets(s, g1, g2)
-                continue
+    def _parent_rows(self, parent_ids):
+        # the known parents go first, like [p for p in [parent1, parent2] if p]
+        parent_ids = np.where((parent_ids[:, :1] == 0) & (parent_ids[:, 1:] != 0),
+                              parent_ids[:, ::-1], parent_ids)
+        parents = np.full(parent_ids.shape, -1, dtype=np.int32)
+        known = parent_ids != 0
+        parents[known] = self.rows_of(parent_ids[known])
+        return parents
 
-            # cycle through all loci
-            p = s.parents[0]
-            for i in range(self.M):
-                if g1[i] != 0:                  # we already know this locus
-                    continue
-                if p.is_homozigota_at(i) and p.allels[2 * i] != 0: # parent is homozygota, but current specie is not
-                    g1[i] = p.allels[2 * i]
-                    g1[self.M] = p.id                # the parent for the gamete
-                    g2[i] = 3 - p.allels[2 * i]     # 2->1, 1->2
-                    if len(s.parents) == 2:
-                        g2[self.M] = s.parents[1].id   # the parent for the gamete
-                    continue
-                else:
-                    if len(s.parents) == 2:       # look at the other parent
-                        m = s.parents[1]
-                        if m.is_homozigota_at(i) and m.allels[2 * i] != 0:
-                            g2[i] = m.allels[2 * i]
-                            g2[self.M] = m.id
-                            g1[i] = 3 - m.allels[2 * i]
-                            g1[self.M] = p.id
+    #
+    #   Append organisms (their parents may be among them too) and reveal their gametes.
+    #   The row arrays keep spare room, so adding a few organisms does not copy the whole pedigree.
+    #   Returns the rows of the new organisms
+    #
+    def add_organisms(self, ids, parent_ids, sexes, genotypes):
+        start = len(self.ids)
+        n = start + len(ids)
+        self._grow("ids", n)[start:] = ids
+        self._grow("sexes", n)[start:] = sexes
+        self._grow("genotypes", n)[start:] = genotypes
+        self._id_order = np.argsort(self.ids, kind="mergesort")
+        self._grow("parents", n)[start:] = self._parent_rows(np.asarray(parent_ids).reshape(-1, 2))
+        for name in ("gamets1", "gamets2", "gamete_parents"):
+            self._grow(name, n)
+        self.number_of_species = n
+        self._link_children()
+        rows = np.arange(start, n)
+        self.reveal_gametes(rows)
+        return rows
+
+    def set_genotype(self, o, allels):
+        self._grow("genotypes", len(self.ids))[o] = allels
+
+    # the row array name resized to n rows, writable
+    def _grow(self, name, n):
+        array = getattr(self, name)
+        buffers = self.__dict__.setdefault("_buffers", {})
+        buffer = buffers.get(name)
+        if buffer is None or len(buffer) < n or not np.may_share_memory(buffer, array):
+            buffer = np.zeros((max(n, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+            buffer[:min(n, len(array))] = array[:n]
+            buffers[name] = buffer
+        setattr(self, name, buffer[:n])
+        return buffer[:n]
 
+    # the arrays kept in the binary pedigree file
+    COLUMNS = ("ids", "sexes", "genotypes", "parents", "child_ptr", "child_index",
+               "gamets1", "gamets2", "gamete_parents")
+
+    def columns(self):
+        columns = {name: getattr(self, name) for name in Pedigree.COLUMNS}
+        columns["id_order"] = self._id_order
+        return columns
+
+    #
+    #   The pedigree from the arrays of columns(), the gametes are already revealed there
+    #
+    @classmethod
+    def from_columns(cls, M, locs_names, columns):
+        pedigree = cls.__new__(cls)
+        pedigree.M = M
+        pedigree.number_of_species = len(columns["ids"])
+        pedigree.locs_names = locs_names
+        for name in Pedigree.COLUMNS:
+            setattr(pedigree, name, columns[name])
+        pedigree._id_order = columns["id_order"]
+        pedigree.phasing = "parents"
+        pedigree.imputed = None
+        return pedigree
+
+    #
+    #   The pedigree of the loci only, with the gametes and the phasing of this one
+    #
+    def select_loci(self, loci):
+        loci = np.asarray(loci, dtype=np.intp)
+        allels = np.column_stack([2 * loci, 2 * loci + 1]).ravel()
+        columns = self.columns()
+        columns["genotypes"] = self.genotypes[:, allels]
+        columns["gamets1"] = self.gamets1[:, loci]
+        columns["gamets2"] = self.gamets2[:, loci]
+        pedigree = Pedigree.from_columns(len(loci), [self.locs_names[i] for i in loci], columns)
+        pedigree.phasing = self.phasing
+        pedigree.imputed = None if self.imputed is None else self.imputed[:, allels]
+        return pedigree
+
+    # rows of the organisms with the given ids
+    def rows_of(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            if ids.size:
+                raise KeyError(int(ids.flat[0]))
+            return ids.astype(np.intp)
+        position = np.searchsorted(self.ids, ids, sorter=self._id_order)
+        rows = self._id_order[np.minimum(position, len(self.ids) - 1)]
+        missing = self.ids[rows] != ids
+        if missing.any():
+            raise KeyError(int(ids[missing].flat[0]))
+        return rows
+
+    def _link_children(self):
+        # children of every parent, in the order of the records
+        child, k = np.nonzero(self.parents >= 0)
+        parent = self.parents[child, k]
+        order = np.argsort(parent, kind="mergesort")
+        self.child_index = child[order].astype(np.int32)
+        counts = np.bincount(parent, minlength=len(self.ids))
+        self.child_ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+
+    @property
+    def organisms(self):
+        return [Pedigree.Organism(self, i) for i in range(len(self.ids))]
+
+    def organism(self, id):
+        return Pedigree.Organism(self, int(self.rows_of([id])[0]))
+
+    def children_of(self, o):
+        return self.child_index[self.child_ptr[o]:self.child_ptr[o + 1]]
+
+    #
+    #   The gamete in the old list form: M allels and the id of the parent in the last slot
+    #
+    def gamete(self, o, k):
+        gamets = self.gamets2 if k else self.gamets1
+        p = self.gamete_parents[o, k]
+        return gamets[o].tolist() + [int(self.ids[p]) if p >= 0 else 0]
+
+    # the genotypes the gametes and the counts come from
+    def effective_genotypes(self):
+        return self.genotypes if self.imputed is None else self.imputed
+
+    # reveal all the gametes again with one of PHASINGS
+    def set_phasing(self, phasing):
+        if phasing not in PHASINGS:
+            raise ValueError("unknown phasing: %r" % (phasing,))
+        self.phasing = phasing
+        self.reveal_gametes()
+
+    #
+    #   Reveal the gametes of the organisms in rows, of all of them by default. The gametes
+    #   of an organism depend only on its own genotypes and the ones of its parents, so
+    #   block_rows organisms are done at once, every rule a mask over their loci.
+    #   The "iterative" phasing imputes the genotypes of all the organisms again, a change
+    #   of one of them may reach any of its descendants, so all the gametes are revealed then
+    #
+    def reveal_gametes(self, rows=None, block_rows=1024):
+        with profiling.stage("reveal_gametes"):
+            self.imputed = impute_genotypes(self, block_rows) if self.phasing == "iterative" else None
+            if self.imputed is not None:
+                rows = None
+            genotypes = self.effective_genotypes()
+            first = genotypes[:, 0::2]
+            second = genotypes[:, 1::2]
+            if rows is None:
+                rows = np.arange(len(self.ids))
+                self.gamets1 = np.zeros(first.shape, dtype=np.int8)
+                self.gamets2 = np.zeros(first.shape, dtype=np.int8)
+                self.gamete_parents = np.zeros(self.parents.shape, dtype=np.int32)
+            else:
+                # the arrays mapped from a binary pedigree file are read-only, copied once here
+                for name in ("gamets1", "gamets2", "gamete_parents"):
+                    if not getattr(self, name).flags.writeable:
+                        self._grow(name, len(self.ids))
+            rows = np.asarray(rows, dtype=np.intp)
             #
             #  31.05.13  Sysoev. It is useful to assign equal gametes to the parents, because homozygota child of
             #  heterozygota parent can be useful for further data retrival
+            #  (so the first gamete always comes from the first parent, and the second one from the second)
             #
-            if g1[self.M] == 0:
-                g1[self.M] = s.parents[0].id
-            if g2[self.M] == 0 and len(s.parents) == 2:
-                g2[self.M] = s.parents[1].id
-            # print g1
-            # print g2
-            # print
-            store_gamets(s, g1, g2)
-
-    def get_cistrans_matrix(self, stat=True, order_hint=None):
+            self.gamete_parents[rows] = self.parents[rows]
+
+            for start in range(0, len(rows), block_rows):
+                block = rows[start:start + block_rows]
+                # init the gametes, we know them where the specie is homozygota
+                g1 = np.where(first[block] == second[block], first[block], 0)
+                g2 = g1.copy()
+                unknown = g1 == 0
+                p, m = self.parents[block].T
+                # parent is homozygota, but current specie is not
+                allel = first[p]
+                from_p = unknown & (allel == second[p]) & (allel != 0) & (p >= 0)[:, None]
+                g1[from_p] = allel[from_p]
+                g2[from_p] = 3 - allel[from_p]        # 2->1, 1->2
+                # look at the other parent
+                allel = first[m]
+                from_m = unknown & ~from_p & (allel == second[m]) & (allel != 0) & ((p >= 0) & (m >= 0))[:, None]
+                g2[from_m] = allel[from_m]
+                g1[from_m] = 3 - allel[from_m]
+                self.gamets1[block] = g1
+                self.gamets2[block] = g2
+
+    def get_cistrans_matrix(self, stat=True, order_hint=None, engine="python", workers=1):
+        if engine not in CISTRANS_ENGINES:
+            raise ValueError("unknown cis/trans engine: %r" % (engine,))
+        with profiling.stage("cistrans"):
+            # the counts of every parent go straight to the int64 arrays of count_cistrans,
+            # the pairs without data are a mask of their own, the lists are made once at the end
+            parents = self.parent_rows()
+            rec, nonrec, defined = self.count_cistrans(parents, stat, order_hint, engine, workers)
+            with profiling.stage("merge"):
+                return cistrans_matrix(rec, nonrec, defined, len(parents))
+
+    def _organism_cistrans_python(self, o, stat, order_hint):
+        with profiling.stage("organism_cistrans"):
+            return self._organism_cistrans_python_counts(o, stat, order_hint)
+
+    def _organism_cistrans_python_counts(self, o, stat, order_hint):
+        allels = self.effective_genotypes()[o].tolist()
+        het_loci = [i for i in range(self.M) if allels[2 * i] != allels[2 * i + 1]]
+        gamets1 = self.gamets1[o].tolist()
+        gamets2 = self.gamets2[o].tolist()
+        children_gametes = self.transmitted_gametes(o).tolist()
+        if profiling.active():
+            self._count_meioses(o, het_loci)
         # init the CIS - TRANS estimation matrix
-        def zero_cistrans():
-            return [[None] * self.M for _ in range(self.M)]
+        ret = [[None] * self.M for _ in range(self.M)]
+        # the counts of (i, j) and (j, i) are the same, only i <= j are counted
+        for (i, j) in itertools.combinations_with_replacement(het_loci, 2):
+            type1 = type2 = rec = nonrec = 0
+            for gamete in children_gametes:
+                if gamete[i] == 0 or gamete[j] == 0:    # the meiosis was uninformative on these loci
+                    continue
 
-        def add_cistrans(a, b):
-            def f(x):
-                return (0, 0) if x is None else x
-            return [[(ra + rb, nra + nrb)
-                     for ((ra, nra), (rb, nrb)) in zip(map(f, ra), map(f, rb))]
-                    for (ra, rb) in zip(a, b)]
-
-        def organism_cistrans(o):
-            het_loci = [i for i in range(self.M) if not o.is_homozigota_at(i)]
-            ret = zero_cistrans()
-            for (i, j) in itertools.product(het_loci, repeat=2):
-                type1 = type2 = rec = nonrec = 0
-                for ch in o.children:
-                    gamete = {ch.gamets1[self.M]: ch.gamets1,
-                              ch.gamets2[self.M]: ch.gamets2}[o.id]
-                    if gamete[i] == 0 or gamete[j] == 0:    # the meiosis was uninformative on these loci
-                        continue
-
-                    if gamete[i] == gamete[j]:
-                        type1 += 1                # AB or ab
-                    else:
-                        type2 += 1                # Ab or AB
-
-                    # gather the reliable info
-                    # if (gamete[i], gamete[j]) in [(o.gamets1[i], o.gamets2[j]),
-                    #                               (o.gamets2[i], o.gamets1[j])]:
-
-                    if ((gamete[i] == o.gamets1[i] and gamete[j] == o.gamets2[j]) or
-                        (gamete[i] == o.gamets2[i] and gamete[j] == o.gamets1[j])):
-                        rec += 1                # RECOMBINATION
-                    else:
-                        nonrec += 1             # NO RECOMBINATION
-
-                if stat and len(o.children) > 4:
-                    if rec < min(type1, type2):
-                        # print rec, nonrec, type1, type2
-                        nonrec = max(type1, type2)
-                        rec = min(type1, type2)
-
-                ret[i][j] = (rec, nonrec)
-            if order_hint:
-                for i, left in enumerate(order_hint):
-                    for j, right in enumerate(order_hint[i+1:], i+1):
-                        prev = order_hint[j-1]
-                        if ret[left][right] is None:
-                            ret[left][right] = ret[right][left] = ret[left][prev]
-
-            return ret
-
-        cistranses = (organism_cistrans(o) for o in self.organisms if o.children)
-        return reduce(add_cistrans, cistranses)
-
-    #
-    #   Given the recombinations, calculate the fractions
-    #
-    def get_pairwise_recombination_distance_matrix(self, order_hint=None):
-        matrix = self.get_cistrans_matrix(order_hint=order_hint)
-        # for row in matrix:
-        #     print(row)
-        fracs = [[1.0 * rec / max(1, rec + nonrec) for (rec, nonrec) in row]
-                 for row in matrix]
-        return fracs
-
-def not_empty_lines(f):
-    return itertools.ifilter(lambda x: x,
-        itertools.imap(lambda x: x.strip(), f))
-#
-#    Open and parse the .GEN file
-#
-def open_file(name=None):
-    f = sys.stdin
-    lines = not_empty_lines(f)
-
-    next(lines)                 # number of FAMILIES - not used, assumed 1
-    M = int(next(lines))       # number of loci
-    locs_names = next(lines).split()  # names of loci
-
-    next(lines)                 # read family number
-    number_of_species = int(next(lines))
-
-    records = []               # data array for the whole pedigree
-    for _ in range(number_of_species):                  # READ FAMILY
-        id, p1, p2, sex = map(int, next(lines).split())     # read species
-        allels = [int(a) for a in next(lines).split()]
-        records.append(OrganismRecord(id, p1, p2, sex, allels))
-
-    return Pedigree(M, number_of_species, locs_names, records)
-
-#
-#    Given the recombination fractions matrix, try to form the order
-#
-def form_cluster(M, matrix):
-    best_cluster = None
-    best_cluster_len = 0
-
-    #
-    # try to form cluster from every node, than choose best
-    #
-    for locus in range(M):
-        temp = [True] * M
-        cluster = []
-        temp[locus] = False                # mark as used
-        cluster.append(locus)
-
-        # find the first neighbor
-        neighbor = None
-        dist = 1
-        for i in range(M):
-            if temp[i] and matrix[locus][i] < dist:
-                neighbor = i
-                dist = matrix[locus][i]
-        if not neighbor:
-            if len(cluster) > best_cluster_len:
-                best_cluster_len = len(cluster)
-                best_cluster = cluster
-            continue
+                if gamete[i] == gamete[j]:
+                    type1 += 1                # AB or ab
+                else:
+                    type2 += 1                # Ab or AB
 
-        cluster.append(neighbor)
-        temp[neighbor] = False
-
-        # find the second neighbor
-        neighbor2 = None
-        dist = 1
-        for i in range(M):
-            if temp[i] and matrix[locus][i] < dist:
-                neighbor2 = i
-                dist = matrix[locus][i]
-        if not neighbor2:
-            if len(cluster) > best_cluster_len:
-                best_cluster_len = len(cluster)
-                best_cluster = cluster
-            continue
-        total_length = matrix[neighbor][neighbor2]
-
-        # build the chain
-        while True:
-            locus = neighbor
-            neighbor = None
-            dist = 1
-            for i in range(M):
-                if temp[i] and matrix[locus][i] < dist and matrix[locus][i] <= total_length:
-                    neighbor = i
-                    dist = matrix[locus][i]
-            if not neighbor:
-                if len(cluster) > best_cluster_len:
-                    best_cluster_len = len(cluster)
-                    best_cluster = cluster
-                break
-
-            cluster.append(neighbor)
-            temp[neighbor] = False
-            #
-            # fixing the situation with equal fractions
-            #
-            for i in range(M):
-                if temp[i] and matrix[locus][i] <= dist and matrix[locus][i] <= total_length:
-                    cluster.append(i)
-                    temp[i] = False
-            total_length += dist
-    return best_cluster
-
-#
-#  We've formed the cluster, but oops.. some loci are not in it. Inserting them...
-#
-def insert_locus(cluster, locus, matrix):
-    # find the closest neighbor
-    neighbor1 = None
-    dist1 = 1
-    for i in range(len(cluster)):
-        if matrix[cluster[i]][locus] < dist1:
-            dist1 = matrix[cluster[i]][locus]
-            neighbor1 = i
-
-    if neighbor1 == 0:                        # near the beginning
-        if matrix[locus][cluster[1]] > matrix[cluster[0]][cluster[1]]:
-            cluster.insert(0, locus)        # our locus is the first
-        else:
-            cluster.insert(1, locus)        # no, it is the second
-        return cluster
-    if neighbor1 == len(cluster) - 1:        # near the end
-        if matrix[locus][cluster[neighbor1 - 1]] > matrix[cluster[neighbor1]][cluster[neighbor1 - 1]]:
-            cluster.insert(neighbor1 + 1, locus)        # it is last
+                # gather the reliable info
+                # if (gamete[i], gamete[j]) in [(gamets1[i], gamets2[j]),
+                #                               (gamets2[i], gamets1[j])]:
+
+                if ((gamete[i] == gamets1[i] and gamete[j] == gamets2[j]) or
+                    (gamete[i] == gamets2[i] and gamete[j] == gamets1[j])):
+                    rec += 1                # RECOMBINATION
+                else:
+                    nonrec += 1             # NO RECOMBINATION
+
+            if stat and len(children_gametes) > 4:
+                if rec < min(type1, type2):
+                    # print rec, nonrec, type1, type2
+                    nonrec = max(type1, type2)
+                    rec = min(type1, type2)
+
+            ret[i][j] = ret[j][i] = (rec, nonrec)
+        if order_hint:
+            for i, left in enumerate(order_hint):
+                for j, right in enumerate(order_hint[i+1:], i+1):
+                    prev = order_hint[j-1]
+                    if ret[left][right] is None:
+                        ret[left][right] = ret[right][left] = ret[left][prev]
+
+        return ret
+
+    #
+    #   The cis/trans counts of the parents in rows summed up, as (rec, nonrec, defined)
+    #   SymmetricMatrix's, where defined marks the pairs some parent had data for.
+    #   With workers > 1 the parents are split over a process pool, each worker sums
+    #   its share into its own arrays, and the shares are added up pairwise
+    #
+    def count_cistrans(self, rows, stat=True, order_hint=None, engine="numpy", workers=1):
+        if workers > 1 and len(rows) > 1:
+            n_chunks = min(len(rows), 4 * workers)
+            tasks = [(rows[k::n_chunks], stat, order_hint, engine) for k in range(n_chunks)]
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+            try:
+                parts = pool.map(_count_cistrans_worker, tasks)
+            finally:
+                pool.terminate()
+                pool.join()
+            with profiling.stage("merge"):
+                return tree_sum(parts)
+
+        counts = (SymmetricMatrix(self.M, dtype=np.int64),
+                  SymmetricMatrix(self.M, dtype=np.int64),
+                  SymmetricMatrix(self.M, dtype=bool))
+        for o in rows:
+            self._add_organism_cistrans(o, stat, order_hint, engine, *counts)
+        return counts
+
+    #
+    #   The counts of count_cistrans for the pairs of loci within width of each other in
+    #   order, an approximate order of all the loci, as condensed.BandedMatrix's: O(M * width)
+    #   time and memory instead of O(M^2). The heterozygous loci of a parent are taken in
+    #   the approximate order, block_rows of them against the loci up to width after them
+    #
+    def count_cistrans_banded(self, rows, order, width, stat=True, block_rows=256):
+        rec = BandedMatrix(order, width, dtype=np.int64)
+        nonrec = BandedMatrix(order, width, dtype=np.int64)
+        defined = BandedMatrix(order, width, dtype=bool)
+        genotypes = self.effective_genotypes()
+        for o in rows:
+            with profiling.stage("organism_cistrans"):
+                allels = genotypes[o]
+                het = np.flatnonzero(allels[0::2] != allels[1::2])
+                het = het[np.argsort(rec.rank[het], kind="mergesort")]
+                ranks = rec.rank[het]
+                G = self.transmitted_gametes(o)[:, het]
+                g1, g2 = self.gamets1[o, het], self.gamets2[o, het]
+                for start in range(0, len(het), block_rows):
+                    stop = min(len(het), start + block_rows)
+                    end = int(np.searchsorted(ranks, ranks[stop - 1] + width, "right"))
+                    r, n = cistrans_counts(G[:, start:end], g1[start:end], g2[start:end], stat,
+                                           np.arange(stop - start))
+                    distance = ranks[None, start:end] - ranks[start:stop, None]
+                    i, j = np.nonzero((distance >= 0) & (distance <= width))
+                    a, b = het[start + i], het[start + j]
+                    rec.add_pairs(a, b, r[i, j])
+                    nonrec.add_pairs(a, b, n[i, j])
+                    defined.add_pairs(a, b, True)
+        return rec, nonrec, defined
+
+    def _add_organism_cistrans(self, o, stat, order_hint, engine, rec, nonrec, defined):
+        if engine == "python":
+            ret = self._organism_cistrans_python(o, stat, order_hint)
+            # only the pairs with data, the matrix is symmetric so i <= j
+            cells = [(i, j, x[0], x[1]) for (i, row) in enumerate(ret)
+                     for (j, x) in enumerate(row[i:], i) if x is not None]
+            i, j, r, n = np.array(cells, dtype=np.int64).reshape(-1, 4).T
+            rec.add_pairs(i, j, r)
+            nonrec.add_pairs(i, j, n)
+            defined.add_pairs(i, j, True)
+            return
+
+        with profiling.stage("organism_cistrans"):
+            het, r, n = self._organism_cistrans_numpy(o, stat)
+        if order_hint:
+            cells = np.ix_(het, het)
+            r_full = np.zeros((self.M, self.M), dtype=np.int64)
+            n_full = np.zeros((self.M, self.M), dtype=np.int64)
+            d_full = np.zeros((self.M, self.M), dtype=bool)
+            r_full[cells] = r
+            n_full[cells] = n
+            d_full[cells] = True
+            fill_order_hint(order_hint, r_full, n_full, d_full)
+            loci = np.arange(self.M)
+            rec.add(loci, np.where(d_full, r_full, 0))
+            nonrec.add(loci, np.where(d_full, n_full, 0))
+            defined.add(loci, d_full)
         else:
-            cluster.insert(neighbor1, locus)                # no, before the last
-        return cluster
+            rec.add(het, r)
+            nonrec.add(het, n)
+            defined.add(het, True)
+
+    # rows of the organisms that have children
+    def parent_rows(self):
+        return np.flatnonzero(np.diff(self.child_ptr)).tolist()
+
+    #
+    #   The same counts as _organism_cistrans_python, but for all the pairs of loci at once.
+    #   The gametes the parent passed to its children form an (n_children x M) array,
+    #   so every count over the children is a product of two 0/1 matrices
+    #
+    def transmitted_gametes(self, o):
+        children = self.children_of(o)
+        # the same lookup as {g1[M]: g1, g2[M]: g2}[o.id]
+        second = (self.gamete_parents[children, 1] == o)[:, None]
+        return np.where(second, self.gamets2[children], self.gamets1[children])
+
+    def _organism_cistrans_numpy(self, o, stat):
+        allels = self.effective_genotypes()[o]
+        het = np.flatnonzero(allels[0::2] != allels[1::2])
+        if profiling.active():
+            self._count_meioses(o, het)
+        rec, nonrec = cistrans_counts(self.transmitted_gametes(o)[:, het],
+                                      self.gamets1[o, het], self.gamets2[o, het], stat)
+        return het, rec, nonrec
+
+    #
+    #   The profiling counters of a parent: its children are the meioses, the ones
+    #   with none of the heterozygous loci known in the gamete tell nothing; the locus
+    #   pairs are the pairs i <= j of its heterozygous loci, the ones the counts are kept for
+    #
+    def _count_meioses(self, o, het):
+        known = (self.transmitted_gametes(o)[:, het] != 0).any(axis=1)
+        profiling.count("parents")
+        profiling.count("meioses", len(known))
+        profiling.count("informative_meioses", int(known.sum()))
+        profiling.count("uninformative_children", int(len(known) - known.sum()))
+        profiling.count("het_locus_pairs", len(het) * (len(het) + 1) // 2)
+
+    #
+    #   Given the recombinations, calculate the fractions. The python engine gives the lists
+    #   of the reference code, the others count the pairs i < j only and the fractions are
+    #   a SymmetricMatrix, so no M x M matrix is ever made
+    #
+    def get_pairwise_recombination_distance_matrix(self, order_hint=None, engine="python", workers=1):
+        if engine == "python" and workers == 1:
+            matrix = self.get_cistrans_matrix(order_hint=order_hint, engine=engine, workers=workers)
+            # for row in matrix:
+            #     print(row)
+            return recombination_fractions(matrix)
+        if engine not in CISTRANS_ENGINES:
+            raise ValueError("unknown cis/trans engine: %r" % (engine,))
+        with profiling.stage("cistrans"):
+            rec, nonrec, defined = self.count_cistrans(self.parent_rows(), True, order_hint, engine, workers)
+        return fraction_matrix(rec, nonrec)
+
+#
+#   The generation of every organism: 0 for the founders, one more than the latest
+#   of its parents for the others
+#
+def generations(parents):
+    generation = np.zeros(len(parents), dtype=np.int64)
+    for _ in range(len(parents) + 1):
+        latest = np.where(parents >= 0, generation[parents] + 1, 0).max(axis=1)
+        if np.array_equal(latest, generation):
+            return generation
+        generation = latest
+    raise ValueError("the pedigree has a cycle")
+
+#
+#   The genotypes of the pedigree with the unknown allels imputed where the relatives
+#   leave one choice (the allels are 1 and 2):
+#         down  - both parents are homozygous, the organism got one allel of each
+#         up    - some children are homozygous for 1 and some for 2, the organism has both
+#   The organisms go generation by generation, block_rows of them at once. The ones
+#   a change can help, the children and the parents of the changed organisms, are
+#   marked and done again, the parents on the next pass, until nothing changes.
+#   An allel is only imputed once, so the passes end
+#
+def impute_genotypes(pedigree, block_rows=1024):
+    with profiling.stage("impute_genotypes"):
+        genotypes = pedigree.genotypes.copy()
+        first = genotypes[:, 0::2]
+        second = genotypes[:, 1::2]
+        parents = pedigree.parents
+        generation = generations(parents)
+        by_generation = np.argsort(generation, kind="mergesort")
+        levels = np.split(by_generation, np.cumsum(np.bincount(generation))[:-1])
+        todo = np.ones(len(parents), dtype=bool)
+        while todo.any():
+            profiling.count("imputation_passes")
+            for level in levels:
+                rows = level[todo[level]]
+                todo[rows] = False
+                for start in range(0, len(rows), block_rows):
+                    block = rows[start:start + block_rows]
+                    changed = block[_impute_block(pedigree, first, second, block)]
+                    todo[_children_of_rows(pedigree, changed)[0]] = True
+                    related = parents[changed].ravel()
+                    todo[related[related >= 0]] = True
+        return genotypes
+
+# the children of the rows, one after another, and the position in rows of the parent of each
+def _children_of_rows(pedigree, rows):
+    starts = pedigree.child_ptr[rows]
+    counts = pedigree.child_ptr[np.asarray(rows) + 1] - starts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return pedigree.child_index[np.repeat(starts, counts) + offsets], owner
+
+# impute the allels of the block in first, second; which of its rows changed
+def _impute_block(pedigree, first, second, block):
+    allel1, allel2 = first[block], second[block]
+    unknown = (allel1 == 0) | (allel2 == 0)
+    p, m = pedigree.parents[block].T
+    both = ((p >= 0) & (m >= 0))[:, None]
+    from_p, from_m = first[p], first[m]
+    down = (unknown & both & (from_p == second[p]) & (from_p != 0)
+            & (from_m == second[m]) & (from_m != 0))
+    allel1[down] = from_p[down]
+    allel2[down] = from_m[down]
+
+    up = np.zeros_like(down)
+    children, owner = _children_of_rows(pedigree, block)
+    if len(children):
+        homozygous = first[children] == second[children]
+        starts = np.flatnonzero(np.diff(np.concatenate([[-1], owner])))
+        has = owner[starts]
+        ones = np.logical_or.reduceat(homozygous & (first[children] == 1), starts, axis=0)
+        twos = np.logical_or.reduceat(homozygous & (first[children] == 2), starts, axis=0)
+        up[has] = ones & twos
+        up &= unknown & ~down
+        allel1[up] = 1
+        allel2[up] = 2
+
+    first[block] = allel1
+    second[block] = allel2
+    return (down | up).any(axis=1)
+
+#
+#   The counts of a parent from the (children x loci) gametes G it passed and its own
+#   gametes g1, g2 on the loci: (rec, nonrec) of every pair of the loci, or only of
+#   the pairs (rows[i], j) when rows, indexes of some of the loci, are given
+#
+def cistrans_counts(G, g1, g2, stat, rows=None):
+    def pairs(a, b):
+        # number of children with a[:, i] and b[:, j], for every (i, j); the sums of 0/1
+        # in float32 are exact up to 2**24 children
+        if rows is not None:
+            a = a[:, rows]
+        return np.dot(a.T.astype(np.float32), b.astype(np.float32)).astype(np.int64)
 
-    # it is in the middle. But what is this neighbor? Right or Left?
-    if matrix[locus][cluster[neighbor1 - 1]] < matrix[cluster[neighbor1]][cluster[neighbor1 - 1]]:
-        cluster.insert(neighbor1, locus)
+    known = G != 0                  # the meiosis was informative on the locus
+    informative = pairs(known, known)
+    type1 = np.zeros_like(informative)
+    for allel in np.unique(G[known]):
+        same = G == allel
+        type1 += pairs(same, same)  # AB or ab
+    type2 = informative - type1      # Ab or aB
+
+    p1 = known & (G == g1)
+    p2 = known & (G == g2)
+    both = p1 & p2
+    if rows is None:
+        rec = pairs(p1, p2)
+        rec = rec + rec.T - pairs(both, both)
     else:
-        cluster.insert(neighbor1 + 1, locus)
-    return cluster
+        rec = pairs(p1, p2) + pairs(p2, p1) - pairs(both, both)
+    nonrec = informative - rec
+
+    if stat and len(G) > 4:
+        fix = rec < np.minimum(type1, type2)
+        rec = np.where(fix, np.minimum(type1, type2), rec)
+        nonrec = np.where(fix, np.maximum(type1, type2), nonrec)
+    return rec, nonrec
+
+def recombination_fractions(matrix):
+    with profiling.stage("fracs"):
+        return [[1.0 * rec / max(1, rec + nonrec) for (rec, nonrec) in row]
+                for row in matrix]
+
+#
+#   The same from the rec and nonrec SymmetricMatrix's. From the BandedMatrix's of
+#   count_cistrans_banded the fractions are banded too, the pairs out of the band
+#   read as unlinked, 0.5
+#
+def fraction_matrix(rec, nonrec):
+    with profiling.stage("fracs"):
+        def fractions(r, n):
+            return r / np.maximum(1, r + n).astype(np.float64)
+        if isinstance(rec, BandedMatrix):
+            return BandedMatrix(rec.order, rec.width, fractions(rec.values, nonrec.values), 0.5)
+        return SymmetricMatrix(rec.M, fractions(rec.values, nonrec.values),
+                               fractions(rec.diagonal, nonrec.diagonal))
+
+#
+#   The (ids, parent_ids, sexes, genotypes) arrays of a list of OrganismRecord
+#
+def record_arrays(M, records):
+    n = len(records)
+    return (np.array([r.id for r in records], dtype=np.int64).reshape(n),
+            np.array([[r.parent1, r.parent2] for r in records], dtype=np.int64).reshape(n, 2),
+            np.array([r.sex for r in records], dtype=np.int8).reshape(n),
+            np.array([r.allels for r in records], dtype=np.int8).reshape(n, 2 * M))
+
+#
+#   The cis/trans counts of a pedigree that keep up with its changes.
+#   Every parent adds its own counts to the sums, so when organisms are added or
+#   re-genotyped only the parents whose counts depend on them are subtracted,
+#   recounted and added back. The counts are the ones of the "numpy" engine
+#   (without order_hint): get_cistrans_matrix() equals
+#   pedigree.get_cistrans_matrix(stat, engine="numpy") of the changed pedigree
+#
+class CistransAccumulator(object):
+    def __init__(self, pedigree, stat=True):
+        self.pedigree = pedigree
+        self.stat = stat
+        M = pedigree.M
+        self.rec = SymmetricMatrix(M, dtype=np.int64)
+        self.nonrec = SymmetricMatrix(M, dtype=np.int64)
+        # number of the parents with data for every pair
+        self.coverage = SymmetricMatrix(M, dtype=np.int32)
+        self._apply(pedigree.parent_rows(), 1)
+
+    def _apply(self, rows, sign):
+        ped = self.pedigree
+        for o in rows:
+            if ped.child_ptr[o] == ped.child_ptr[o + 1]:
+                continue
+            het, r, n = ped._organism_cistrans_numpy(o, self.stat)
+            self.rec.add(het, sign * r)
+            self.nonrec.add(het, sign * n)
+            self.coverage.add(het, sign)
+
+    # rows of the known parents of the organisms in rows
+    def _parents_of(self, rows):
+        parents = self.pedigree.parents[rows].ravel()
+        return parents[parents >= 0]
+
+    #
+    #   Append OrganismRecord's to the pedigree. Their parents may be old organisms
+    #   or among the records, the children must not be in the pedigree yet
+    #
+    def add_organisms(self, records):
+        ped = self.pedigree
+        ids, parent_ids, sexes, genotypes = record_arrays(ped.M, records)
+        if ped.phasing == "iterative":
+            # the imputed allels may change all over the pedigree
+            self._apply(ped.parent_rows(), -1)
+            rows = ped.add_organisms(ids, parent_ids, sexes, genotypes)
+            self._apply(ped.parent_rows(), 1)
+            return rows
+        known = parent_ids[parent_ids != 0]
+        old = np.unique(ped.rows_of(known[np.in1d(known, ids, invert=True)]))
+        self._apply(old, -1)
+        rows = ped.add_organisms(ids, parent_ids, sexes, genotypes)
+        self._apply(np.union1d(old, self._parents_of(rows)), 1)
+        return rows
+
+    #
+    #   Change the allels of the organism with the given id. Its gametes and the ones of its
+    #   children are revealed again, which changes the counts of all of them,
+    #   of its parents and of the other parents of its children
+    #
+    def update_genotype(self, id, allels):
+        ped = self.pedigree
+        o = int(ped.rows_of([id])[0])
+        revealed = np.concatenate([[o], ped.children_of(o)]).astype(np.intp)
+        affected = np.unique(np.concatenate([revealed, self._parents_of(revealed)]))
+        if ped.phasing == "iterative":
+            affected = ped.parent_rows()
+        self._apply(affected, -1)
+        ped.set_genotype(o, allels)
+        ped.reveal_gametes(revealed)
+        self._apply(affected, 1)
+
+    def get_cistrans_matrix(self):
+        return cistrans_matrix(self.rec, self.nonrec, np.asarray(self.coverage) > 0,
+                               len(self.pedigree.parent_rows()))
+
+    def get_pairwise_recombination_distance_matrix(self):
+        return fraction_matrix(self.rec, self.nonrec)
+
+#
+#   An (n x M) matrix of bools in 1 bit each, 8 columns to a byte (np.packbits).
+#   b[rows, columns] reads the bools back, any index of the rows and an index
+#   of the columns; b[rows] = bools packs a block of rows in
+#
+class PackedBits(object):
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.bits = np.zeros((shape[0], (shape[1] + 7) // 8), dtype=np.uint8)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, rows, bools):
+        self.bits[rows] = np.packbits(bools, axis=-1)
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        bits = self.bits[rows]
+        if isinstance(columns, slice) or 8 * len(columns) >= self.shape[1]:
+            # most of the bytes are read anyway, unpackbits them all
+            return np.unpackbits(bits, axis=-1)[..., :self.shape[1]][..., columns].view(bool)
+        columns = np.asarray(columns)
+        shift = (7 - (columns & 7)).astype(np.uint8)
+        return ((bits[..., columns >> 3] >> shift) & 1).astype(bool)
+
+    # the columns of the loci alone, packed again block_rows rows at a time
+    def columns(self, loci, block_rows=4096):
+        out = type(self)((self.shape[0], len(loci)))
+        for start in range(0, self.shape[0], block_rows):
+            out[start:start + block_rows] = self[start:start + block_rows, loci]
+        return out
+
+#
+#   The gametes of the meioses when 0, 1 and 2 are the only allels: the allel is
+#   known and it is 2, two PackedBits instead of an int8 per gamete. g[meioses, loci]
+#   reads the int8 gametes back, like the slice of the (meioses x M) array
+#
+class PackedGametes(PackedBits):
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.known = PackedBits(shape)
+        self.allel = PackedBits(shape)
+
+    def __setitem__(self, rows, gametes):
+        self.known[rows] = gametes != 0
+        self.allel[rows] = gametes == 2
+
+    def __getitem__(self, key):
+        gametes = self.known[key].view(np.int8)
+        gametes += self.allel[key].view(np.int8)
+        return gametes
+
+#
+#   The recombination fractions computed when they are asked for, for the marker panels
+#   too big for the M x M matrix. It reads like the matrix: f[i] is a row, f[a:b] or
+#   f[loci] some rows, f[rows, columns] the values at the broadcast index arrays.
+#   The rows come in blocks from the per-parent products of the "numpy" engine, the last
+#   cache_rows of them are kept; the pairs asked for by the index are counted over all
+#   the meioses at once. The gametes every parent passed are copied when it is made, in
+#   PackedGametes when they fit, the changes of the pedigree after that are not seen
+#
+class LazyFractions(PairMatrix):
+    def __init__(self, pedigree, stat=True, cache_rows=1024, block_rows=256):
+        self.M = pedigree.M
+        self.stat = stat
+        self.cache_rows = cache_rows
+        self.block_rows = block_rows
+        self._cache = collections.OrderedDict()
+        parents = np.array(pedigree.parent_rows(), dtype=np.intp)
+        self._children = np.diff(pedigree.child_ptr)[parents]
+        self._starts = np.concatenate([[0], np.cumsum(self._children)])
+        # one row per meiosis, the ones of a parent together; the allels 0, 1, 2 in 2 bits
+        shape = (self._starts[-1], self.M)
+        biallelic = all(len(g) == 0 or (g.min() >= 0 and g.max() <= 2)
+                        for g in (pedigree.gamets1, pedigree.gamets2))
+        self._meioses = PackedGametes(shape) if biallelic else np.zeros(shape, dtype=np.int8)
+        for (k, o) in enumerate(parents):
+            self._meioses[self._starts[k]:self._starts[k + 1]] = pedigree.transmitted_gametes(o)
+        allels = pedigree.effective_genotypes()[parents]
+        self._het = PackedBits(allels[:, 0::2].shape)
+        self._het[:] = allels[:, 0::2] != allels[:, 1::2]
+        self._gamets1 = pedigree.gamets1[parents]
+        self._gamets2 = pedigree.gamets2[parents]
+
+    # the fractions of the pairs of the loci alone, numbered 0 .. len(loci) - 1 in their
+    # order: the same meioses on the columns of the loci, nothing is counted yet
+    def submatrix(self, loci):
+        loci = np.asarray(loci, dtype=np.intp)
+        sub = copy.copy(self)
+        sub.M = len(loci)
+        sub._cache = collections.OrderedDict()
+        if isinstance(self._meioses, PackedBits):
+            sub._meioses = self._meioses.columns(loci)
+        else:
+            sub._meioses = self._meioses[:, loci]
+        sub._het = self._het.columns(loci)
+        sub._gamets1 = self._gamets1[:, loci]
+        sub._gamets2 = self._gamets2[:, loci]
+        return sub
+
+    def row(self, i):
+        row = self._cache.pop(i, None)
+        if row is None:
+            return self.rows_of([i])[0]
+        self._cache[i] = row
+        profiling.count("fraction_row_hits")
+        return row
+
+    # the (len(loci) x M) rows of the loci
+    def rows_of(self, loci):
+        loci = np.asarray(loci, dtype=np.int64)
+        out = np.empty((len(loci), self.M))
+        missing = collections.OrderedDict()
+        for (k, locus) in enumerate(loci.tolist()):
+            row = self._cache.pop(locus, None)
+            if row is None:
+                missing.setdefault(locus, []).append(k)
+            else:
+                self._cache[locus] = row
+                out[k] = row
+        missing_loci = sorted(missing)
+        for start in range(0, len(missing_loci), self.block_rows):
+            block = missing_loci[start:start + self.block_rows]
+            for (locus, row) in zip(block, self._fraction_rows(np.array(block))):
+                out[missing[locus]] = row
+                self._cache[locus] = row.copy()
+                if len(self._cache) > self.cache_rows:
+                    self._cache.popitem(last=False)
+        return out
+
+    def _fraction_rows(self, loci):
+        with profiling.stage("fraction_rows"):
+            rec, nonrec = self.count_rows(loci)
+            return rec / np.maximum(1, rec + nonrec).astype(np.float64)
+
+    # the (rec, nonrec) counts of the rows of the loci
+    def count_rows(self, loci):
+        profiling.count("fraction_rows", len(loci))
+        rec = np.zeros((len(loci), self.M), dtype=np.int64)
+        nonrec = np.zeros((len(loci), self.M), dtype=np.int64)
+        het_loci = self._het[:, loci]
+        for k in range(len(self._children)):
+            rows = np.flatnonzero(het_loci[k])
+            if not len(rows):
+                continue
+            het = np.flatnonzero(self._het[k])
+            G = self._meioses[self._starts[k]:self._starts[k + 1], het]
+            r, n = cistrans_counts(G, self._gamets1[k, het], self._gamets2[k, het], self.stat,
+                                   np.searchsorted(het, loci[rows]))
+            cells = np.ix_(rows, het)
+            rec[cells] += r
+            nonrec[cells] += n
+        return rec, nonrec
+
+    # the values at the pairs of the broadcast index arrays
+    def pair(self, i, j):
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+        if i.ndim == 0:
+            for (a, b) in ((int(i), int(j)), (int(j), int(i))):
+                if a in self._cache:
+                    return self._cache[a][b]
+        return self._fraction_pairs(i.ravel(), j.ravel()).reshape(i.shape)[()]
+
+    #
+    #   The fractions of the pairs (a[k], b[k]) with the python engine conditions
+    #   checked on every meiosis, summed up for every parent with np.add.reduceat
+    #
+    def _fraction_pairs(self, a, b, batch=1 << 22):
+        profiling.count("fraction_pairs", len(a))
+        out = np.zeros(len(a))
+        if not len(self._children):
+            return out
+        step = max(1, batch // max(1, len(self._meioses)))
+        fix = self.stat & (self._children > 4)
+        for start in range(0, len(a), step):
+            A, B = a[start:start + step], b[start:start + step]
+            Ga, Gb = self._meioses[:, A], self._meioses[:, B]
+
+            def per_meiosis(gamets, loci):
+                return np.repeat(gamets[:, loci], self._children, axis=0)
+
+            def per_parent(x):
+                return np.add.reduceat(x.astype(np.int64), self._starts[:-1], axis=0) * het
+
+            het = self._het[:, A] & self._het[:, B]
+            known = (Ga != 0) & (Gb != 0)
+            rec = per_parent(known & (((Ga == per_meiosis(self._gamets1, A)) & (Gb == per_meiosis(self._gamets2, B))) |
+                                      ((Ga == per_meiosis(self._gamets2, A)) & (Gb == per_meiosis(self._gamets1, B)))))
+            informative = per_parent(known)
+            type1 = per_parent(known & (Ga == Gb))
+            type2 = informative - type1
+            nonrec = informative - rec
+            low = np.minimum(type1, type2)
+            fixed = fix[:, None] & (rec < low)
+            rec = np.where(fixed, low, rec).sum(axis=0)
+            nonrec = np.where(fixed, np.maximum(type1, type2), nonrec).sum(axis=0)
+            out[start:start + step] = rec / np.maximum(1, rec + nonrec).astype(np.float64)
+        return out
+
+    # the rows come from the cache and the blocks of rows_of, not from pair
+    def _rows(self, loci):
+        if loci.ndim == 0:
+            return self.row(int(loci))
+        return self.rows_of(loci.ravel()).reshape(loci.shape + (self.M,))
+
+#
+#   LOD score of the linkage of pairs with rec recombinant and nonrec non recombinant
+#   meioses: log10 of the likelihood at the fraction rec / (rec + nonrec) against
+#   the one at 1/2, 0 where the fraction is 1/2 or more
+#
+def lod_scores(rec, nonrec):
+    rec = np.asarray(rec, dtype=np.float64)
+    nonrec = np.asarray(nonrec, dtype=np.float64)
+    n = rec + nonrec
+    theta = np.minimum(rec / np.maximum(1, n), 0.5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (n * np.log10(2) + np.where(rec > 0, rec * np.log10(theta), 0)
+                + np.where(nonrec > 0, nonrec * np.log10(1 - theta), 0))
+
+#
+#   The pairs of loci linked by the counts: with data, the fraction max_fraction at most
+#   and the LOD score min_lod at least. The phases of the parents are taken to fit the
+#   children, so the fractions of unlinked loci come out near 0.3 here, not 0.5, and their
+#   LOD scores are high too: the fraction decides. On pedigree_generator maps of 3
+#   chromosomes of 1 - 1.5 Morgans, 1000 - 2000 organisms of 30 founders, the closest
+#   loci of different chromosomes are at 0.22 and more, while the loci of a chromosome of
+#   the testing datasets need 0.19 - 0.22 to come together. Small pedigrees of a few
+#   founders mix the chromosomes at any of the thresholds
+#
+LINKAGE_FRACTION = 0.2
+LINKAGE_LOD = 3.0
+
+def linked_pairs(rec, nonrec, max_fraction=LINKAGE_FRACTION, min_lod=LINKAGE_LOD):
+    n = rec + nonrec
+    return (n > 0) & (rec <= max_fraction * n) & (lod_scores(rec, nonrec) >= min_lod)
+
+#
+#   The linkage groups of M loci, count_rows(start, stop) gives the (rec, nonrec)
+#   counts of the rows of the loci (see ordering.linkage_groups)
+#
+def group_loci(M, count_rows, max_fraction=LINKAGE_FRACTION, min_lod=LINKAGE_LOD):
+    def linked(start, stop):
+        rec, nonrec = count_rows(start, stop)
+        return linked_pairs(rec, nonrec, max_fraction, min_lod)
+    with profiling.stage("groups"):
+        return linkage_groups(M, linked)
+
+#
+#   The bins of the loci passed the same way in all the meioses: for every child and
+#   parent, which of the parent's gametes the child got at the locus (0 where the meiosis
+#   tells nothing, as for count_cistrans). There is no recombination between the loci
+#   of a bin, so one of them can be ordered for all. Every locus column of the meioses
+#   is hashed, block_loci of them at a time; the loci of no informative meiosis get
+#   bins of their own. The bins are lists of the loci, in the order of their first loci
+#
+def locus_bins(pedigree, block_loci=1024):
+    genotypes = pedigree.effective_genotypes()
+    rows, k = np.nonzero(pedigree.gamete_parents >= 0)
+    parents = pedigree.gamete_parents[rows, k]
+    bins = collections.OrderedDict()
+    for start in range(0, pedigree.M, block_loci):
+        stop = min(pedigree.M, start + block_loci)
+        loci = slice(start, stop)
+        allel = np.where(k[:, None] == 1, pedigree.gamets2[rows, loci], pedigree.gamets1[rows, loci])
+        g1, g2 = pedigree.gamets1[parents, loci], pedigree.gamets2[parents, loci]
+        het = genotypes[parents, 2 * start:2 * stop:2] != genotypes[parents, 2 * start + 1:2 * stop:2]
+        known = het & (allel != 0)
+        passed = np.where(known & (allel == g1) & (g1 != 0), 1,
+                          np.where(known & (allel == g2) & (g2 != 0), 2, 0)).astype(np.int8)
+        columns = np.ascontiguousarray(passed.T)
+        informative = columns.any(axis=1)
+        for (locus, column) in enumerate(columns, start):
+            key = hashlib.sha1(column.tobytes()).digest() if informative[locus - start] else locus
+            bins.setdefault(key, []).append(locus)
+    return list(bins.values())
+
+#
+#   The k closest loci of every locus with the support of the pairs, (M x k) arrays:
+#         index         - the loci, closest first, the equal ones in the order of the loci
+#         fracs         - their recombination fractions
+#         rec, nonrec   - the counts the fractions come from
+#         lod           - LOD scores of the counts
+#   The index and fracs are the neighbor lists of ordering.form_cluster, which takes
+#   the index instead of making them. It is built from the rows of LazyFractions, a block
+#   at a time, so the whole matrix is never there, and is saved like the binary pedigree
+#
+class NeighborIndex(object):
+    SUFFIX = ".knn"
+
+    def __init__(self, index, fracs, rec, nonrec, stat=True, phasing="parents"):
+        self.index = index
+        self.fracs = fracs
+        self.rec = rec
+        self.nonrec = nonrec
+        self.lod = lod_scores(rec, nonrec)
+        self.stat = stat
+        self.phasing = phasing
+
+    @property
+    def k(self):
+        return self.index.shape[1]
+
+    @classmethod
+    def build(cls, pedigree, k=NEIGHBORS, stat=True, block_rows=256):
+        with profiling.stage("neighbor_index"):
+            M = pedigree.M
+            k = min(k, M)
+            lazy = LazyFractions(pedigree, stat, cache_rows=0)
+            index = np.empty((M, k), dtype=np.int32)
+            fracs = np.empty((M, k))
+            rec = np.empty((M, k), dtype=np.int64)
+            nonrec = np.empty((M, k), dtype=np.int64)
+            for start in range(0, M, block_rows):
+                loci = np.arange(start, min(M, start + block_rows))
+                r, n = lazy.count_rows(loci)
+                block = r / np.maximum(1, r + n).astype(np.float64)
+                closest = np.argsort(block, axis=1, kind="mergesort")[:, :k]
+                rows = np.arange(len(loci))[:, None]
+                index[loci] = closest
+                fracs[loci] = block[rows, closest]
+                rec[loci] = r[rows, closest]
+                nonrec[loci] = n[rows, closest]
+            return cls(index, fracs, rec, nonrec, stat, pedigree.phasing)
+
+    def save(self, path, locs_names, source=None):
+        genfile.write_binary(path, len(self.index), locs_names,
+                             {"index": self.index, "fracs": self.fracs,
+                              "rec": self.rec, "nonrec": self.nonrec},
+                             source, genfile.INDEX_MAGIC, {"stat": self.stat, "phasing": self.phasing})
+
+    # (index, header) of the file
+    @classmethod
+    def load(cls, path):
+        header, columns = genfile.read_binary(path, genfile.INDEX_MAGIC)
+        return cls(columns["index"], columns["fracs"], columns["rec"], columns["nonrec"],
+                   header["stat"], header.get("phasing", "parents")), header
+
+#
+#   The index of the pedigree file path, kept next to it (path + NeighborIndex.SUFFIX):
+#   read when it was made from the current file with the same stat, the same phasing of
+#   the pedigree and k neighbors at least, built and saved otherwise
+#
+def load_neighbor_index(path, pedigree, k=NEIGHBORS, stat=True):
+    if not genfile.is_path(path):
+        return NeighborIndex.build(pedigree, k, stat)
+    cached = path + NeighborIndex.SUFFIX
+    if os.path.exists(cached):
+        try:
+            index, header = NeighborIndex.load(cached)
+            if (genfile.source_matches(header, path) and header["stat"] == stat
+                    and index.phasing == pedigree.phasing and index.k >= min(k, pedigree.M)):
+                return index
+        except (ValueError, KeyError):
+            pass                # broken index file, make it again
+    source = genfile.source_info(path)
+    index = NeighborIndex.build(pedigree, k, stat)
+    index.save(cached, pedigree.locs_names, source)
+    return index
+
+#
+#   The counts arrays in the form of get_cistrans_matrix: (rec, nonrec) for every pair
+#
+def cistrans_matrix(rec, nonrec, defined, n_parents):
+    defined = np.asarray(defined)
+    matrix = [list(zip(r, n)) for (r, n) in zip(rec.tolist(), nonrec.tolist())]
+    if n_parents == 1:
+        # the matrix of the only parent as it is, with None for the missing pairs
+        for (i, j) in zip(*np.nonzero(~defined)):
+            matrix[i][j] = None
+    return matrix
+
+def tree_sum(parts):
+    while len(parts) > 1:
+        pairs = [parts[k:k + 2] for k in range(0, len(parts), 2)]
+        parts = [pair[0] if len(pair) == 1 else
+                 tuple(a + b if a.dtype != bool else a | b for (a, b) in zip(*pair))
+                 for pair in pairs]
+    return parts[0]
+
+#
+#   The process pool workers of Pedigree.count_cistrans
+#
+_worker_pedigree = None
+
+def _init_worker(pedigree):
+    global _worker_pedigree
+    _worker_pedigree = pedigree
+
+def _count_cistrans_worker(task):
+    rows, stat, order_hint, engine = task
+    return _worker_pedigree.count_cistrans(rows, stat, order_hint, engine)
+
+#
+#   Vectorized order_hint pass of _organism_cistrans_python. Going along the hint, a pair
+#   (left, right) with no data takes the value of (left, prev), so each row of the
+#   hint is forward filled starting from its diagonal, and the filled cells are mirrored
+#
+def fill_order_hint(order_hint, rec, nonrec, defined):
+    cells = np.ix_(order_hint, order_hint)
+    r = rec[cells]
+    nr = nonrec[cells]
+    d = defined[cells]
+
+    positions = np.arange(len(order_hint))
+    upper = positions[None, :] > positions[:, None]
+    source = np.where(d & upper, positions[None, :], -1)
+    source[positions, positions] = positions
+    source = np.maximum.accumulate(source, axis=1)
+
+    i, j = np.nonzero(upper & ~d)
+    k = source[i, j]
+    for (a, b) in ((i, j), (j, i)):
+        r[a, b] = r[i, k]
+        nr[a, b] = nr[i, k]
+        d[a, b] = d[i, k]
+    rec[cells] = r
+    nonrec[cells] = nr
+    defined[cells] = d
+
+#
+#    Open and parse the .GEN file - a path, a binary file object or None for stdin
+#
+def open_file(name=None, digest=None):
+    with profiling.stage("parse"):
+        data = genfile.read_gen(name, digest=digest)
+    with profiling.stage("pedigree"):
+        return Pedigree.from_arrays(data.M, data.locs_names, data.ids, data.parents,
+                                    data.sexes, data.genotypes)
+
+BINARY_SUFFIX = ".genb"
+
+#
+#    Write the binary pedigree file (genfile.write_binary) for the .GEN file source,
+#    by default next to it
+#
+def convert(source, dest=None):
+    dest = dest or source + BINARY_SUFFIX
+    st = os.stat(source)
+    digest = hashlib.sha1()
+    pedigree = open_file(source, digest)
+    genfile.write_binary(dest, pedigree.M, pedigree.locs_names, pedigree.columns(),
+                         genfile.source_info(source, digest.hexdigest(), st))
+    return pedigree
+
+def read_binary(path):
+    with profiling.stage("load"):
+        header, columns = genfile.read_binary(path)
+    return Pedigree.from_columns(header["M"], header["locs_names"], columns), header
+
+#
+#    The pedigree of a .GEN or a binary file. The .GEN file is read through its binary copy
+#    when convert() has made one; the copy is rebuilt when the source has changed
+#
+def load_pedigree(path):
+    if genfile.is_binary(path):
+        return read_binary(path)[0]
+    cached = path + BINARY_SUFFIX
+    if not os.path.exists(cached):
+        return open_file(path)
+    try:
+        pedigree, header = read_binary(cached)
+        if genfile.source_matches(header, path):
+            return pedigree
+    except (ValueError, KeyError):
+        pass                    # broken binary file, make it again
+    return convert(path, cached)
+
+#
+#   The approximate order of the loci for count_cistrans_banded from the positions in
+#   their names (genfile.locus_position), the chromosomes in the order of their first loci
+#
+def name_order(locs_names):
+    chromosomes = {}
+    keys = []
+    for name in locs_names:
+        chromosome, position = genfile.locus_position(name)
+        keys.append((chromosomes.setdefault(chromosome, len(chromosomes)), position))
+    return sorted(range(len(locs_names)), key=keys.__getitem__)
+
+#
+#   The approximate order from a map genmap.py printed before: the loci in the order of
+#   the names in the first column of its lines, the loci the map does not have after them
+#
+def map_order(path, locs_names):
+    loci = dict((name, i) for (i, name) in enumerate(locs_names))
+    order = []
+    placed = set()
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#") or fields[0] not in loci:
+                continue
+            locus = loci[fields[0]]
+            if locus not in placed:
+                placed.add(locus)
+                order.append(locus)
+    return order + [locus for locus in range(len(locs_names)) if locus not in placed]
+
+#
+#   The stages of the mapping of one pedigree, each one run when it is first needed
+#   and its result kept, so a program can go on from any of them:
+#         load       - the pedigree of file_name (load_pedigree), or of an opened pedigree
+#         phase      - the gametes revealed with one of PHASINGS
+#         bin        - with binning, the locus_bins and the pedigree of their first loci;
+#                      the later stages map that one and the bins are expanded in lines()
+#         count      - the (rec, nonrec, defined) counts of count_cistrans, or of
+#                      count_cistrans_banded with band
+#         fractions  - the recombination fractions, LazyFractions with lazy
+#         order      - the orders of the loci, one per linkage group
+#   The arguments are the ones of process_pedigree; the counts are read from and saved
+#   to the cache, a countscache.CountsCache, when there is one (the banded counts are
+#   not kept). Nothing runs at import, like:
+#
+#       pipeline = Pipeline("my_file.gen", engine="numpy")
+#       pipeline.order(ordering="greedy")
+#       pipeline.write(sys.stdout)
+#       pipeline.fracs, pipeline.counts     # still there
+#
+class Pipeline(object):
+    def __init__(self, file_name=None, stat=True, engine="python", workers=1, phasing="parents",
+                 lazy=False, cache_rows=1024, pedigree=None, cache=None, band=None, band_order=None,
+                 binning=False):
+        if engine not in CISTRANS_ENGINES:
+            raise ValueError("unknown cis/trans engine: %r" % (engine,))
+        if phasing not in PHASINGS:
+            raise ValueError("unknown phasing: %r" % (phasing,))
+        if band is not None and lazy:
+            raise ValueError("the banded counts do not go with the lazy fractions")
+        self.file_name = file_name
+        self.stat = stat
+        self.engine = engine
+        self.workers = workers
+        self.phasing = phasing
+        self.lazy = lazy
+        self.cache_rows = cache_rows
+        self.pedigree = pedigree
+        self.cache = cache
+        self.band = band
+        self.band_order = band_order
+        self.binning = binning
+        self.phased = False
+        self.bins = None
+        self.binned = None
+        self.counts = None
+        self.fracs = None
+        self.neighbor_index = None
+        self.groups = None
+        self.orders = None
+
+    def load(self):
+        if self.pedigree is None:
+            name = self.file_name
+            self.pedigree = load_pedigree(name) if genfile.is_path(name) else open_file(name)
+        return self.pedigree
+
+    def phase(self):
+        pedigree = self.load()
+        if not self.phased:
+            if pedigree.phasing != self.phasing:
+                pedigree.set_phasing(self.phasing)
+            self.phased = True
+        return pedigree
+
+    def bin(self):
+        pedigree = self.phase()
+        if self.bins is None:
+            with profiling.stage("bins"):
+                self.bins = locus_bins(pedigree)
+                self.binned = pedigree.select_loci([b[0] for b in self.bins])
+            profiling.count("bins", len(self.bins))
+        return self.binned
+
+    # the pedigree the map is made of, the one of the bins with binning
+    def mapped(self):
+        return self.bin() if self.binning else self.phase()
+
+    # the loci as the mapped pedigree has them, the bins of the loci in the order they first come
+    def _mapped_loci(self, loci):
+        if not self.binning:
+            return list(loci)
+        self.bin()
+        bin_of = np.empty(self.pedigree.M, dtype=np.int64)
+        for (b, members) in enumerate(self.bins):
+            bin_of[members] = b
+        bins = bin_of[np.asarray(loci, dtype=np.int64)]
+        return bins[np.sort(np.unique(bins, return_index=True)[1])].tolist()
+
+    # the approximate order of the banded counts: of the map band_order, or of the names
+    def approximate_order(self):
+        names = self.load().locs_names
+        if self.band_order is None:
+            order = name_order(names)
+        elif genfile.is_path(self.band_order):
+            order = map_order(self.band_order, names)
+        else:
+            order = self.band_order
+        return self._mapped_loci(order)
+
+    def count(self):
+        if self.counts is None and self.band is not None:
+            pedigree = self.mapped()
+            with profiling.stage("cistrans"):
+                self.counts = pedigree.count_cistrans_banded(pedigree.parent_rows(),
+                                                             self.approximate_order(),
+                                                             self.band, self.stat)
+        if self.counts is None:
+            pedigree = self.mapped()
+            key = counts_key(pedigree, self.stat) if self.cache is not None else None
+            if key is not None:
+                self.counts = self.cache.get(key)
+                profiling.count("cached_counts", int(self.counts is not None))
+            if self.counts is None:
+                with profiling.stage("cistrans"):
+                    self.counts = pedigree.count_cistrans(pedigree.parent_rows(), self.stat, None,
+                                                          self.engine, self.workers)
+                if key is not None:
+                    # the cache only saves time, a run never fails for it
+                    try:
+                        self.cache.put(key, self.counts)
+                    except (IOError, OSError) as error:
+                        perr("genmap: the counts are not cached in %s: %s" % (self.cache.directory, error))
+        return self.counts
+
+    def fractions(self):
+        if self.fracs is None:
+            if self.lazy:
+                self.fracs = LazyFractions(self.mapped(), self.stat, self.cache_rows)
+            else:
+                rec, nonrec, _ = self.count()
+                self.fracs = fraction_matrix(rec, nonrec)
+        return self.fracs
+
+    # the (rec, nonrec) counts of the rows of the loci start..stop
+    def count_rows(self, start, stop):
+        if self.lazy:
+            return self.fractions().count_rows(np.arange(start, stop))
+        rec, nonrec, _ = self.count()
+        return rec[start:stop], nonrec[start:stop]
+
+    #
+    #   The orders of the loci, as process_pedigree makes them; neighbors is the size of the
+    #   NeighborIndex form_cluster takes, that one needs lazy fractions and a file name
+    #
+    def order(self, order=None, ordering=None, refine=True, time_budget=None, neighbors=None,
+              groups=False, max_fraction=LINKAGE_FRACTION, min_lod=LINKAGE_LOD):
+        if neighbors and self.binning:
+            raise ValueError("the bins do not go with the NeighborIndex of the file")
+        pedigree = self.mapped()
+        groups = groups and not order
+        if order:
+            order = self._mapped_loci(order)
+        if neighbors and not groups and self.neighbor_index is None:
+            self.neighbor_index = load_neighbor_index(self.file_name, pedigree, neighbors, self.stat)
+        fracs = self.fractions()
+        with profiling.stage("order"):
+            if order:
+                # the loci missing in the known order are inserted into it
+                self.orders = [complete_order(order, fracs)]
+            elif groups:
+                self.groups = group_loci(pedigree.M, self.count_rows, max_fraction, min_lod)
+                self.orders = order_groups(fracs, self.groups, ordering, refine, time_budget, self.workers)
+            elif ordering is None:
+                cluster = form_cluster(pedigree.M, fracs, neighbors=self.neighbor_index)
+                if self.band is not None:
+                    # the pairs out of the band read as unlinked and end the cluster early,
+                    # the loci left out of it are inserted instead of being lost
+                    cluster = complete_order(cluster, fracs)
+                self.orders = [cluster]
+            else:
+                self.orders = [order_loci(fracs, ordering, refine, time_budget)]
+        return self.orders
+
+    # the orders of the loci of the pedigree, the bins expanded
+    def locus_orders(self):
+        if not self.binning:
+            return self.orders
+        return [[locus for b in order for locus in self.bins[b]] for order in self.orders]
+
+    #
+    #   The map as process_pedigree prints it: the loci of every order with the fractions
+    #   to the next one, an empty line between the orders. The fractions next to the loci
+    #   of the bins are not in the mapped fractions, they come from the whole pedigree
+    #
+    def lines(self):
+        names = self.pedigree.locs_names
+        fracs = self.fracs
+        if self.binning and any(len(b) > 1 for b in self.bins):
+            fracs = LazyFractions(self.pedigree, self.stat)
+        lines = []
+        for (g, cluster) in enumerate(self.locus_orders()):
+            if g > 0:
+                lines.append("")
+            steps = neighbor_fractions(fracs, cluster)
+            lines.extend("%s     %s" % (names[locus], step) for (locus, step) in zip(cluster, steps))
+            lines.extend(names[locus] for locus in cluster[len(steps):])
+        return lines
+
+    def write(self, out):
+        with profiling.stage("output"):
+            for line in self.lines():
+                out.write(line + "\n")
 
 #
 #    process the pedigree. Main function in the module
 #         file_name - name of the CHR file with the pedigree data
 #         order - order of loci that already known
 #         stat - boolean value, whether to use statistical results
+#         engine - how to count cis/trans pairs, one of CISTRANS_ENGINES
+#         workers - number of processes counting cis/trans pairs
+#         ordering - one of ORDERING_ENGINES to order all the loci, by default only the cluster is printed
+#         refine, time_budget - see order_loci
+#         lazy - compute the fractions when the ordering asks for them (LazyFractions)
+#                instead of the whole matrix, keeping cache_rows rows of them
+#         index - form the cluster with the NeighborIndex of the file (load_neighbor_index)
+#                 of the given number of neighbors; the fractions are lazy then
+#         phasing - one of PHASINGS, how the gametes are revealed
+#         groups - split the loci into linkage groups (group_loci) by max_fraction and
+#                  min_lod, order every group alone on workers processes and print
+#                  them one after another, an empty line between them
+#         cache - a countscache.CountsCache to keep the counts in for the next runs
+#         band - count only the pairs of loci within band of each other in band_order,
+#                an approximate order: a list of the loci, the path of an earlier map,
+#                or None for the positions in the names of the loci (name_order);
+#                without ordering the loci left out of the cluster are inserted into it
+#         binning - order one locus of every bin of locus_bins, its bin next to it;
+#                   the fractions returned are the ones of those loci then (Pipeline.binned)
 #
 #    use it like:
 #            process_pedigree("c:\\my_file.gen")
 #       process_pedigree("c:\\my_file.gen", range(10), False) # first 10 loci are in the right order, use only the reliable results
 #
-def process_pedigree(file_name=None, order=None, stat=True):
-    order = order or []
-    pedigree = open_file(file_name)
-    fracs = pedigree.get_pairwise_recombination_distance_matrix()
-    cluster = form_cluster(pedigree.M, fracs)
+def process_pedigree(file_name=None, order=None, stat=True, engine="python", workers=1,
+                     ordering=None, refine=True, time_budget=None, lazy=False, cache_rows=1024,
+                     index=False, neighbors=NEIGHBORS, groups=False,
+                     max_fraction=LINKAGE_FRACTION, min_lod=LINKAGE_LOD, phasing="parents",
+                     cache=None, band=None, band_order=None, binning=False):
+    pipeline = Pipeline(file_name, stat, engine, workers, phasing, lazy or index, cache_rows,
+                        cache=cache, band=band, band_order=band_order, binning=binning)
+    pipeline.order(order, ordering, refine, time_budget, neighbors if index else None,
+                    groups, max_fraction, min_lod)
+    pipeline.write(sys.stdout)
+    return sum(pipeline.locus_orders(), []), pipeline.fracs
 
-    for i in range(len(cluster)):
-        name = pedigree.locs_names[cluster[i]]
-        if i < len(cluster) - 1:
-            print name, '   ', fracs[cluster[i]][cluster[i + 1]]
+# the fractions between the neighbor loci of the order, as floats
+def neighbor_fractions(fracs, order):
+    if hasattr(fracs, "pair"):
+        return fracs.pair(order[:-1], order[1:]).tolist() if len(order) > 1 else []
+    return [fracs[a][b] for (a, b) in zip(order, order[1:])]
+
+#
+#   The .GEN or binary pedigree files of the paths, the files of a directory in the order
+#   of their names, without the binary copies and the indexes made next to the .GEN files
+#
+def batch_files(paths):
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if (os.path.isfile(full) and not name.startswith(".")
+                    and not name.endswith((BINARY_SUFFIX, NeighborIndex.SUFFIX))):
+                files.append(full)
+    return files
+
+#
+#   Map every file in one process, or on a pool of workers processes, a file to a worker.
+#   pipeline_options and order_options go to Pipeline and Pipeline.order. Yields
+#   (file, lines, error) in the order of the files, error is None or the message of
+#   the file that could not be mapped, the others go on
+#
+def map_files(files, pipeline_options=None, order_options=None, workers=1):
+    tasks = [(path, pipeline_options or {}, order_options or {}) for path in files]
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _map_file(task)
+        return
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        for result in pool.imap(_map_file, tasks, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _map_file(task):
+    path, pipeline_options, order_options = task
+    try:
+        pipeline = Pipeline(path, **pipeline_options)
+        pipeline.order(**order_options)
+        return path, pipeline.lines(), None
+    except (IOError, OSError, ValueError, KeyError) as error:
+        return path, None, str(error)
+
+# the options of the map shared by genmap.py and genmap.py batch
+def add_map_arguments(parser):
+    parser.add_argument("--engine", choices=CISTRANS_ENGINES, default="python",
+                        help="cis/trans counting engine")
+    parser.add_argument("--phasing", choices=PHASINGS, default="parents",
+                        help="reveal the gametes from the genotypes of the parents only, or iterate "
+                             "through the generations with the imputed genotypes")
+    parser.add_argument("--ordering", choices=ORDERING_ENGINES,
+                        help="order all the loci with this engine instead of printing the greedy cluster")
+    parser.add_argument("--no-refine", dest="refine", action="store_false",
+                        help="skip the 2-opt/Or-opt refinement of --ordering")
+    parser.add_argument("--time-budget", type=float, metavar="SECONDS",
+                        help="wall-clock limit of --ordering")
+    parser.add_argument("--lazy", action="store_true",
+                        help="compute the fractions on demand instead of the whole matrix, for big marker panels")
+    parser.add_argument("--cache-rows", type=int, default=1024,
+                        help="rows of the fractions --lazy keeps")
+    parser.add_argument("--index", action="store_true",
+                        help="form the cluster with the nearest-locus index kept next to FILE "
+                             "(FILE" + NeighborIndex.SUFFIX + ", built when missing or stale), implies --lazy")
+    parser.add_argument("--neighbors", type=int, default=NEIGHBORS,
+                        help="loci in the list of every locus of --index")
+    parser.add_argument("--groups", action="store_true",
+                        help="split the loci into linkage groups and order every group alone")
+    parser.add_argument("--max-fraction", type=float, default=LINKAGE_FRACTION,
+                        help="largest fraction of the linked pairs of --groups")
+    parser.add_argument("--min-lod", type=float, default=LINKAGE_LOD,
+                        help="smallest LOD score of the linked pairs of --groups")
+    parser.add_argument("--band", type=int, metavar="W",
+                        help="count only the pairs of loci at most W apart in an approximate order, "
+                             "by default the one of the positions at the end of the locus names; "
+                             "the loci out of the cluster are inserted into it")
+    parser.add_argument("--band-order", metavar="MAP",
+                        help="take the approximate order of --band from an earlier map")
+    parser.add_argument("--bins", dest="binning", action="store_true",
+                        help="order one locus of every bin of the loci passed the same way in all "
+                             "the meioses, the others of the bin printed next to it")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="count everything again instead of using the counts of the earlier runs")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="where the counts are kept, default $GENMAP_CACHE or ~/.cache/genmap")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+                        help="the counts used longest ago are removed above this size")
+
+# the (Pipeline, Pipeline.order) keyword arguments of the options of add_map_arguments
+def map_options(args, workers=1):
+    cache = CountsCache(args.cache_dir, args.cache_size << 20) if args.cache else None
+    return ({"engine": args.engine, "workers": workers, "phasing": args.phasing,
+             "lazy": args.lazy or args.index, "cache_rows": args.cache_rows, "cache": cache,
+             "band": args.band, "band_order": args.band_order, "binning": args.binning},
+            {"ordering": args.ordering, "refine": args.refine, "time_budget": args.time_budget,
+             "neighbors": args.neighbors if args.index else None, "groups": args.groups,
+             "max_fraction": args.max_fraction, "min_lod": args.min_lod})
+
+def batch(argv):
+    parser = argparse.ArgumentParser(prog="genmap.py batch",
+                                     description="Map many pedigrees in one process")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help=".GEN or binary pedigree files, or directories of them")
+    parser.add_argument("-o", "--output-dir", metavar="DIR",
+                        help="write the map of every FILE to DIR/FILE.map instead of stdout")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes mapping the files, one file at a time each")
+    add_map_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    failed = 0
+    pipeline_options, order_options = map_options(args)
+    for (path, lines, error) in map_files(batch_files(args.paths), pipeline_options, order_options,
+                                          args.workers):
+        if error is not None:
+            perr("%s: %s" % (path, error))
+            failed += 1
+        elif args.output_dir:
+            with open(os.path.join(args.output_dir, os.path.basename(path) + ".map"), "w") as f:
+                f.write("".join(line + "\n" for line in lines))
         else:
-            print name
+            print "#", path
+            for line in lines:
+                print line
+    return 1 if failed else 0
+
+def main(argv):
+    if argv[:1] == ["convert"]:
+        parser = argparse.ArgumentParser(prog="genmap.py convert",
+                                         description="Write the binary pedigree file for a .GEN file")
+        parser.add_argument("source", help=".GEN file, may be gzip compressed")
+        parser.add_argument("-o", "--output", help="default: SOURCE" + BINARY_SUFFIX)
+        args = parser.parse_args(argv[1:])
+        convert(args.source, args.output)
+        return
+    if argv[:1] == ["batch"]:
+        return batch(argv[1:])
+
+    parser = argparse.ArgumentParser(prog="genmap.py", description="Order the loci of a pedigree",
+                                     epilog="genmap.py convert SOURCE [-o OUTPUT] writes the binary "
+                                            "pedigree file, later runs on SOURCE map it to memory; "
+                                            "genmap.py batch PATH ... maps many files in one process")
+    parser.add_argument("file", nargs="?",
+                        help=".GEN file (may be gzip compressed) or binary pedigree file, stdin by default")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for the cis/trans counting and the --groups")
+    add_map_arguments(parser)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time, memory and counters of every stage as JSON to FILE, - for stderr")
+    parser.add_argument("--profile-dir", metavar="DIR",
+                        help="save a cProfile of every stage in DIR")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the memory allocated in every stage (tracemalloc), or the change "
+                             "of the RSS where there is no tracemalloc; --profile - by default")
+    args = parser.parse_args(argv)
+    if args.trace_memory and not profiling.memory_tracer():
+        parser.error("--trace-memory: neither tracemalloc nor the RSS of the process is there")
+    pipeline_options, order_options = map_options(args, args.workers)
 
-    return cluster, fracs
+    def run():
+        pipeline = Pipeline(args.file, **pipeline_options)
+        pipeline.order(**order_options)
+        pipeline.write(sys.stdout)
+
+    if not (args.profile or args.profile_dir or args.trace_memory):
+        run()
+        return
+
+    with profiling.profile(args.profile_dir, args.trace_memory) as profiler:
+        run()
+    if args.profile in (None, "-"):
+        print >>sys.stderr, profiler.to_json()
+    else:
+        with open(args.profile, "w") as f:
+            f.write(profiler.to_json() + "\n")
 
-process_pedigree()
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
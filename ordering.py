@@ -0,0 +1,773 @@
+'''
+    Orders of the loci from the matrix of the recombination fractions
+
+    form_cluster and insert_locus are the original greedy chain, order_loci
+    is the common entry point of the ordering engines
+'''
+import time
+import collections
+import multiprocessing
+
+import numpy as np
+
+#
+#   The matrices with pair() - condensed.SymmetricMatrix and BandedMatrix, genmap.LazyFractions -
+#   are read as they are, by rows, row blocks and pairs; the lists become a numpy array
+#
+def _readable(matrix):
+    return matrix if hasattr(matrix, "pair") else np.asarray(matrix, dtype=np.float64)
+
+#
+#    Given the recombination fractions matrix, try to form the order
+#
+#
+#   Engines for form_cluster. "python" is the original scan of the rows, "index" grows
+#   the chains of all the seeds at once over sorted neighbor lists, with the same result
+#
+CLUSTER_ENGINES = ("python", "index")
+
+#
+#   The index engine takes the neighbor lists from neighbors, a genmap.NeighborIndex
+#   of the matrix, when there is one; the matrix is only read where the lists end
+#
+def form_cluster(M, matrix, engine="index", neighbors=None):
+    if engine not in CLUSTER_ENGINES:
+        raise ValueError("unknown cluster engine: %r" % (engine,))
+    if engine == "python" or M == 0:
+        return _form_cluster_python(M, matrix)
+    fracs = _readable(matrix)
+    index, values = neighbor_lists(fracs) if neighbors is None else (neighbors.index, neighbors.fracs)
+    lengths = cluster_lengths(fracs, index, values)
+    # the first of the longest ones, as the scan finds it
+    return chain_of(fracs, int(np.argmax(lengths)), index, values)
+
+def _form_cluster_python(M, matrix):
+    best_cluster = None
+    best_cluster_len = 0
+
+    #
+    # try to form cluster from every node, than choose best
+    #
+    for locus in range(M):
+        temp = [True] * M
+        cluster = []
+        temp[locus] = False                # mark as used
+        cluster.append(locus)
+
+        # find the first neighbor
+        neighbor = None
+        dist = 1
+        for i in range(M):
+            if temp[i] and matrix[locus][i] < dist:
+                neighbor = i
+                dist = matrix[locus][i]
+        if not neighbor:
+            if len(cluster) > best_cluster_len:
+                best_cluster_len = len(cluster)
+                best_cluster = cluster
+            continue
+
+        cluster.append(neighbor)
+        temp[neighbor] = False
+
+        # find the second neighbor
+        neighbor2 = None
+        dist = 1
+        for i in range(M):
+            if temp[i] and matrix[locus][i] < dist:
+                neighbor2 = i
+                dist = matrix[locus][i]
+        if not neighbor2:
+            if len(cluster) > best_cluster_len:
+                best_cluster_len = len(cluster)
+                best_cluster = cluster
+            continue
+        total_length = matrix[neighbor][neighbor2]
+
+        # build the chain
+        while True:
+            locus = neighbor
+            neighbor = None
+            dist = 1
+            for i in range(M):
+                if temp[i] and matrix[locus][i] < dist and matrix[locus][i] <= total_length:
+                    neighbor = i
+                    dist = matrix[locus][i]
+            if not neighbor:
+                if len(cluster) > best_cluster_len:
+                    best_cluster_len = len(cluster)
+                    best_cluster = cluster
+                break
+
+            cluster.append(neighbor)
+            temp[neighbor] = False
+            #
+            # fixing the situation with equal fractions
+            #
+            for i in range(M):
+                if temp[i] and matrix[locus][i] <= dist and matrix[locus][i] <= total_length:
+                    cluster.append(i)
+                    temp[i] = False
+            total_length += dist
+    return best_cluster
+
+#
+#   The k closest loci of every locus: (index, fracs) arrays, closest first and,
+#   for the equal fractions, in the order of the loci (the scan prefers the first one)
+#
+NEIGHBORS = 16
+
+def neighbor_lists(fracs, k=NEIGHBORS, block_rows=256):
+    M = len(fracs)
+    k = min(k, M)
+    if hasattr(fracs, "nearest"):
+        # condensed.BandedMatrix, the lists come from its band
+        return fracs.nearest(k)
+    index = np.empty((M, k), dtype=np.int32)
+    values = np.empty((M, k))
+    for start in range(0, M, block_rows):
+        block = fracs[start:start + block_rows]
+        closest = np.argsort(block, axis=1, kind="mergesort")[:, :k]
+        index[start:start + block_rows] = closest
+        values[start:start + block_rows] = block[np.arange(len(block))[:, None], closest]
+    return index, values
+
+#
+#   The rows of the loci, block_rows at a time: (k, rows) for every block of the indexes k.
+#   The pair matrices read a block of rows at once about as fast as a single row
+#
+def _row_blocks(fracs, loci, k, block_rows=256):
+    for start in range(0, len(k), block_rows):
+        block = k[start:start + block_rows]
+        yield block, fracs[loci[block]]
+
+#
+#   The closest loci not used yet: for every chain r, the first free one in the
+#   list of its locus, or in the whole row when all of the list is used
+#
+def _closest_free(fracs, index, values, used, r, loci):
+    free = ~used[r[:, None], index[loci]]
+    at = free.argmax(axis=1)
+    closest = index[loci, at]
+    dist = values[loci, at]
+    for (t, rows) in _row_blocks(fracs, loci, np.flatnonzero(~free.any(axis=1))):
+        rows = np.where(used[r[t]], np.inf, rows)
+        closest[t] = rows.argmin(axis=1)
+        dist[t] = rows[np.arange(len(t)), closest[t]]
+    return dist, closest
+
+#
+#   Length of the cluster form_cluster builds from every seed. All the chains of a batch
+#   of seeds grow at once, a step of every chain looks at the neighbor list of its last locus.
+#   The conditions are the scan ones, with its quirk that the neighbor 0 ends the chain
+#
+def cluster_lengths(fracs, index, values, batch_bytes=1 << 26):
+    M = len(fracs)
+    lengths = np.ones(M, dtype=np.int64)
+    batch = max(1, batch_bytes // max(1, M))
+    for start in range(0, M, batch):
+        seeds = np.arange(start, min(M, start + batch))
+        n = len(seeds)
+        used = np.zeros((n, M), dtype=bool)
+        used[np.arange(n), seeds] = True
+
+        # the first neighbor joins the chain, the second one sets the length
+        r = np.arange(n)
+        dist, first = _closest_free(fracs, index, values, used, r, seeds)
+        ok = (dist < 1) & (first != 0)
+        r, first = r[ok], first[ok]
+        used[r, first] = True
+        lengths[seeds[r]] = 2
+        dist, second = _closest_free(fracs, index, values, used, r, seeds[r])
+        ok = (dist < 1) & (second != 0)
+        r, locus = r[ok], first[ok]
+        total = fracs[locus, second[ok]]
+
+        while len(r):
+            dist, neighbor = _closest_free(fracs, index, values, used, r, locus)
+            ok = (dist < 1) & (dist <= total) & (neighbor != 0)
+            r, locus, total, dist, neighbor = r[ok], locus[ok], total[ok], dist[ok], neighbor[ok]
+            # the neighbor and the free loci as far as it
+            equal = ~used[r[:, None], index[locus]] & (values[locus] == dist[:, None])
+            rows, at = np.nonzero(equal)
+            used[r[rows], index[locus[rows], at]] = True
+            count = equal.sum(axis=1)
+            # the list may end amid the equal ones
+            cut = (values[locus, -1] <= dist) if index.shape[1] < M else np.zeros(len(r), dtype=bool)
+            for (t, rows) in _row_blocks(fracs, locus, np.flatnonzero(cut)):
+                rows, rest = np.divmod(np.flatnonzero(~used[r[t]] & (rows == dist[t, None])), M)
+                used[r[t[rows]], rest] = True
+                count += np.bincount(t[rows], minlength=len(count))
+            lengths[seeds[r]] += count
+            total = total + dist
+            locus = neighbor
+    return lengths
+
+#
+#   The cluster form_cluster builds from the seed. With the neighbor lists
+#   the rows of the matrix are read only when all of a list is used
+#
+def chain_of(fracs, seed, index=None, values=None):
+    M = len(fracs)
+    used = np.zeros(M, dtype=bool)
+
+    def closest(locus):
+        if index is not None:
+            free = ~used[index[locus]]
+            if free.any():
+                at = int(free.argmax())
+                return values[locus, at], int(index[locus, at])
+        row = np.where(used, np.inf, fracs[locus])
+        i = int(row.argmin())
+        return row[i], i
+
+    def equal_free(locus, dist):
+        # the list has all of them unless it ends amid the equal ones
+        if index is not None and (index.shape[1] == M or values[locus, -1] > dist):
+            listed = index[locus][values[locus] == dist]
+            return listed[~used[listed]]
+        return np.flatnonzero(~used & (fracs[locus] == dist))
+
+    cluster = [seed]
+    used[seed] = True
+    dist, neighbor = closest(seed)
+    if not (dist < 1 and neighbor):
+        return cluster
+    cluster.append(neighbor)
+    used[neighbor] = True
+    dist, neighbor2 = closest(seed)
+    if not (dist < 1 and neighbor2):
+        return cluster
+    total_length = fracs[neighbor, neighbor2]
+    while True:
+        locus = neighbor
+        dist, neighbor = closest(locus)
+        if not (dist < 1 and dist <= total_length and neighbor):
+            return cluster
+        # the neighbor is the first of the equal ones
+        equal = np.sort(equal_free(locus, dist))
+        cluster.extend(equal.tolist())
+        used[equal] = True
+        total_length += dist
+
+#
+#  We've formed the cluster, but oops.. some loci are not in it. Inserting them...
+#
+def insert_locus(cluster, locus, matrix):
+    # the matrix is symmetric, the row of the locus is all we need of it
+    distances = matrix[locus]
+    # find the closest neighbor
+    neighbor1 = None
+    dist1 = 1
+    for i in range(len(cluster)):
+        if distances[cluster[i]] < dist1:
+            dist1 = distances[cluster[i]]
+            neighbor1 = i
+
+    if neighbor1 == 0:                        # near the beginning
+        if distances[cluster[1]] > matrix[cluster[0]][cluster[1]]:
+            cluster.insert(0, locus)        # our locus is the first
+        else:
+            cluster.insert(1, locus)        # no, it is the second
+        return cluster
+    if neighbor1 == len(cluster) - 1:        # near the end
+        if distances[cluster[neighbor1 - 1]] > matrix[cluster[neighbor1]][cluster[neighbor1 - 1]]:
+            cluster.insert(neighbor1 + 1, locus)        # it is last
+        else:
+            cluster.insert(neighbor1, locus)                # no, before the last
+        return cluster
+
+    # it is in the middle. But what is this neighbor? Right or Left?
+    if distances[cluster[neighbor1 - 1]] < matrix[cluster[neighbor1]][cluster[neighbor1 - 1]]:
+        cluster.insert(neighbor1, locus)
+    else:
+        cluster.insert(neighbor1 + 1, locus)
+    return cluster
+
+
+#
+#   Engines for order_loci. The order is the shortest path through the loci we can find,
+#   the length of an edge being the recombination fraction:
+#         greedy    - form_cluster, then insert_locus for the loci left out of the cluster
+#         savings   - the savings construction; with the ends of the path free it joins
+#                     the closest pairs of loci first, as long as they make a path
+#         insertion - nearest insertion, the closest locus goes where it lengthens the path least
+#
+ORDERING_ENGINES = ("greedy", "savings", "insertion")
+
+#
+#   The order of all the M loci.
+#         refine - improve the order with the 2-opt and Or-opt moves
+#         time_budget - seconds for the whole call, the refinement stops when they are over
+#         neighbors - number of the closest loci the savings and the moves look at
+#
+def order_loci(fracs, engine="savings", refine=True, time_budget=None, neighbors=NEIGHBORS):
+    if engine not in ORDERING_ENGINES:
+        raise ValueError("unknown ordering engine: %r" % (engine,))
+    deadline = None if time_budget is None else time.time() + time_budget
+    M = len(fracs)
+    if M < 3:
+        return list(range(M))
+
+    if engine == "greedy":
+        order = complete_order(form_cluster(M, fracs), fracs)
+        if not refine:
+            return order
+    # the matrices with pair() are read by rows and pairs, never as the whole square
+    matrix = _readable(fracs)
+    index, values = neighbor_lists(matrix, neighbors + 1)
+    if engine == "savings":
+        order = savings_order(matrix, index, values)
+    elif engine == "insertion":
+        order = insertion_order(matrix, index, values)
+    if refine:
+        # the lists are the fastest to look up one pair at a time
+        if hasattr(fracs, "lookup"):
+            fracs = fracs.lookup()
+        elif hasattr(fracs, "pair"):
+            fracs = _pair_rows(matrix, index, values)
+        order = local_search(fracs, order, index, deadline)
+    return order
+
+# sum of the fractions between the neighbor loci of the order
+def path_length(fracs, order):
+    return sum(fracs[a][b] for (a, b) in zip(order, order[1:]))
+
+#
+#   The cluster with the loci left out of it inserted, like the old process_pedigree did
+#
+def complete_order(cluster, matrix):
+    order = list(cluster)
+    placed = set(order)
+    rest = [locus for locus in range(len(matrix)) if locus not in placed]
+    if not order and rest:
+        order.append(rest.pop(0))
+    return insert_loci(order, rest, matrix)
+
+#
+#   The loci inserted into the cluster one by one, the same as insert_locus for each of them.
+#   The loci come in blocks: the closest locus of the cluster is found for all the loci of
+#   a block at once from their rows and updated as they come in, the cluster itself is
+#   a linked list until all of them are placed. Only block_rows rows are read at a time.
+#   insert_locus can not place a locus next to a single one or far from all of them,
+#   such a locus goes to the end
+#
+def insert_loci(cluster, loci, matrix, block_rows=1024):
+    loci = list(loci)
+    if not loci:
+        return list(cluster)
+    fracs = _readable(matrix)
+    sequence = _Sequence(len(fracs), cluster)
+    for start in range(0, len(loci), block_rows):
+        # the rows of a block of the loci to insert, and the closest locus of the sequence
+        # for every one of them, the first of the equal ones
+        block = loci[start:start + block_rows]
+        rows = fracs[np.array(block)]
+        placed = np.array(sequence.loci())
+        closest = placed[rows[:, placed].argmin(axis=1)]
+        dist = rows[np.arange(len(block)), closest]
+
+        for (k, locus) in enumerate(block):
+            row = rows[k]
+            neighbor = int(closest[k])
+            before, after = sequence.prev[neighbor], sequence.next[neighbor]
+            if not dist[k] < 1 or (before < 0 and after < 0):
+                sequence.insert(sequence.tail, -1, locus)
+            elif before < 0:                                # near the beginning
+                if row[after] > fracs[neighbor, after]:
+                    sequence.insert(-1, neighbor, locus)    # our locus is the first
+                else:
+                    sequence.insert(neighbor, after, locus)     # no, it is the second
+            elif after < 0:                                 # near the end
+                if row[before] > fracs[neighbor, before]:
+                    sequence.insert(neighbor, -1, locus)    # it is last
+                else:
+                    sequence.insert(before, neighbor, locus)    # no, before the last
+            elif row[before] < fracs[neighbor, before]:
+                sequence.insert(before, neighbor, locus)
+            else:
+                sequence.insert(neighbor, after, locus)
+
+            # the locus is in the cluster now, it may be the closest one for the rest of the block
+            rest = slice(k + 1, None)
+            to_rest = rows[rest, locus]
+            labels = sequence.label
+            closer = (to_rest < dist[rest]) | ((to_rest == dist[rest]) & (labels[locus] < labels[closest[rest]]))
+            closest[rest][closer] = locus
+            dist[rest][closer] = to_rest[closer]
+    return sequence.loci()
+
+#
+#   A sequence of loci with the insertion in O(1): the links of every locus and its label.
+#   The labels grow along the sequence, so they tell which of two loci comes first;
+#   when there is no label left between two neighbors, all of them are given again
+#
+class _Sequence(object):
+    LABELS = 1 << 62
+
+    def __init__(self, M, loci):
+        self.prev = [-1] * M
+        self.next = [-1] * M
+        self.label = np.zeros(M, dtype=np.int64)
+        for (a, b) in zip(loci, loci[1:]):
+            self.next[a] = b
+            self.prev[b] = a
+        self.head, self.tail = loci[0], loci[-1]
+        self.length = len(loci)
+        self._relabel()
+
+    def _relabel(self):
+        spacing = self.LABELS // (self.length + 2)
+        for (k, a) in enumerate(self.loci(), 1):
+            self.label[a] = k * spacing
+
+    # put locus between the neighbors a and b, -1 for the ends
+    def insert(self, a, b, locus):
+        low = self.label[a] if a >= 0 else 0
+        high = self.label[b] if b >= 0 else self.LABELS
+        if high - low < 2:
+            self._relabel()
+            low = self.label[a] if a >= 0 else 0
+            high = self.label[b] if b >= 0 else self.LABELS
+        self.label[locus] = (low + high) // 2
+        self.prev[locus], self.next[locus] = a, b
+        if a >= 0:
+            self.next[a] = locus
+        else:
+            self.head = locus
+        if b >= 0:
+            self.prev[b] = locus
+        else:
+            self.tail = locus
+        self.length += 1
+
+    def loci(self):
+        loci = []
+        a = self.head
+        while a >= 0:
+            loci.append(a)
+            a = self.next[a]
+        return loci
+
+#
+#   Adds the edges (a, b) in the given order as long as the loci have less than
+#   two neighbors and are not on the same path yet
+#
+class _Paths(object):
+    def __init__(self, M):
+        self.root = list(range(M))
+        self.links = [[] for _ in range(M)]
+
+    def find(self, a):
+        root = self.root
+        while root[a] != a:
+            root[a] = root[root[a]]
+            a = root[a]
+        return a
+
+    def join(self, edges):
+        for (a, b) in edges:
+            if len(self.links[a]) < 2 and len(self.links[b]) < 2:
+                ra, rb = self.find(a), self.find(b)
+                if ra != rb:
+                    self.root[ra] = rb
+                    self.links[a].append(b)
+                    self.links[b].append(a)
+
+    def ends(self):
+        return [a for a in range(len(self.links)) if len(self.links[a]) < 2]
+
+    def walk(self, start):
+        order = [start]
+        prev, a = None, start
+        while True:
+            following = [b for b in self.links[a] if b != prev]
+            if not following:
+                return order
+            prev, a = a, following[0]
+            order.append(a)
+
+# edges (a, b) of the fractions values sorted by them, the equal ones in the order of the loci
+def _sorted_edges(a, b, values):
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    keep = a != b
+    a, b, values = a[keep], b[keep], values[keep]
+    order = np.lexsort((b, a, values))
+    return zip(a[order].tolist(), b[order].tolist())
+
+# the (len(loci) x len(loci)) fractions between the loci, read block_rows rows at a time
+def _submatrix(matrix, loci, block_rows=256):
+    if isinstance(matrix, np.ndarray):
+        return matrix[np.ix_(loci, loci)]
+    return np.concatenate([matrix[loci[start:start + block_rows]][:, loci]
+                           for start in range(0, len(loci), block_rows)])
+
+#
+#   The savings order from the neighbor lists (index, values) of the matrix,
+#   the matrix itself is only read for the rows of the ends of the paths
+#
+def savings_order(matrix, index, values):
+    M = len(matrix)
+    paths = _Paths(M)
+    k = index.shape[1]
+    paths.join(_sorted_edges(np.repeat(np.arange(M), k), index.ravel(), values.ravel()))
+    # join the paths by their ends, every end looking at the closest other ends
+    while True:
+        ends = np.array(paths.ends())
+        if len(set(paths.find(a) for a in ends.tolist())) == 1:
+            return paths.walk(int(ends[0]))
+        between = _submatrix(matrix, ends)
+        closest = np.argsort(between, axis=1, kind="mergesort")[:, :k]
+        paths.join(_sorted_edges(np.repeat(ends, closest.shape[1]), ends[closest].ravel(),
+                                 between[np.arange(len(ends))[:, None], closest].ravel()))
+
+#
+#   The cheapest insertion, a row of the matrix read for every locus placed; the first
+#   two loci are the closest pair of the neighbor lists (index, values). The lazy matrices,
+#   the ones with rows_of(loci), give read_ahead rows at a time
+#
+def insertion_order(matrix, index, values, read_ahead=128):
+    M = len(matrix)
+    others = np.where(index != np.arange(M)[:, None], values, np.inf)
+    first = int(np.argmin(others.min(axis=1)))
+    row = np.array(matrix[first], dtype=np.float64)
+    first_row = row.copy()
+    row[first] = np.inf
+    second = int(np.argmin(row))
+    order = [first, second]
+    # the fractions between the neighbors of the path
+    steps = [first_row[second]]
+    placed = np.zeros(M, dtype=bool)
+    placed[order] = True
+    closest = np.minimum(first_row, matrix[second])
+    ahead = {}
+    for _ in range(M - 2):
+        candidates = np.where(placed, np.inf, closest)
+        locus = int(np.argmin(candidates))
+        if locus not in ahead and hasattr(matrix, "rows_of"):
+            # the rows computed one at a time are slow, the ones of the loci closest
+            # to the path are read together as the next to be placed
+            loci = np.argsort(candidates, kind="mergesort")[:min(read_ahead, M - len(order))]
+            ahead = dict(zip(loci.tolist(), matrix.rows_of(loci)))
+        row = ahead.pop(locus, None)
+        if row is None:
+            row = np.asarray(matrix[locus], dtype=np.float64)
+        path = np.array(order)
+        # lengthening of the path for the locus before it, between the neighbors and after it
+        costs = np.concatenate([[row[path[0]]],
+                                row[path[:-1]] + row[path[1:]] - np.array(steps),
+                                [row[path[-1]]]])
+        at = int(np.argmin(costs))
+        order.insert(at, locus)
+        steps[max(0, at - 1):at] = [row[p] for p in path[max(0, at - 1):at + 1]]
+        placed[locus] = True
+        closest = np.minimum(closest, row)
+    return order
+
+#
+#   The rows of the matrix as dicts for local_search, the neighbor lists (index, values)
+#   in them from the start and the other pairs read and kept as they are looked up
+#
+def _pair_rows(matrix, index, values):
+    rows = []
+    rows.extend(_PairRow(matrix, a, rows) for a in range(len(matrix)))
+    for (a, (loci, fracs)) in enumerate(zip(index.tolist(), values.tolist())):
+        rows[a].update(zip(loci, fracs))
+    return rows
+
+
+class _PairRow(dict):
+    def __init__(self, matrix, locus, rows):
+        dict.__init__(self)
+        self.matrix = matrix
+        self.locus = locus
+        self.rows = rows
+
+    def __missing__(self, key):
+        value = float(self.matrix[self.locus, key])
+        self[key] = self.rows[key][self.locus] = value
+        return value
+
+#
+#   2-opt and Or-opt moves over the neighbor lists, with the don't-look bits: a locus is
+#   looked at again only when one of its edges has changed. The path is closed into a tour
+#   through an extra "depot" locus with zero fractions to all, so its ends can move too
+#
+IMPROVEMENT = 1e-12
+SEGMENTS = 3            # longest segment the Or-opt moves
+
+def local_search(fracs, order, index, deadline=None):
+    M = len(order)
+    depot = M
+    tour = list(order) + [depot]
+    n = len(tour)
+    pos = [0] * n
+    for (i, a) in enumerate(tour):
+        pos[a] = i
+    neighbors = [[depot] + [c for c in index[a].tolist() if c != a] for a in range(M)] + [[]]
+
+    def dist(a, b):
+        if a == depot or b == depot:
+            return 0.0
+        return fracs[a][b]
+
+    def succ(a):
+        return tour[(pos[a] + 1) % n]
+
+    def pred(a):
+        return tour[pos[a] - 1]
+
+    def reverse(a, b):
+        # reverse the part of the tour from a to b, or the rest of it when that is shorter
+        i, j = pos[a], pos[b]
+        length = (j - i) % n + 1
+        if 2 * length > n:
+            i, j = (j + 1) % n, (i - 1) % n
+            length = n - length
+        for _ in range(length // 2):
+            tour[i], tour[j] = tour[j], tour[i]
+            pos[tour[i]] = i
+            pos[tour[j]] = j
+            i = (i + 1) % n
+            j = (j - 1) % n
+
+    def two_opt(a):
+        for forward in (True, False):
+            b = succ(a) if forward else pred(a)
+            d_ab = dist(a, b)
+            for c in neighbors[a]:
+                gain = d_ab - dist(a, c)
+                if gain <= IMPROVEMENT:
+                    break
+                d = succ(c) if forward else pred(c)
+                if c == b or d == a:
+                    continue
+                if gain + dist(c, d) - dist(b, d) > IMPROVEMENT:
+                    if forward:
+                        reverse(b, c)
+                    else:
+                        reverse(a, d)
+                    return (a, b, c, d)
+        return ()
+
+    def or_opt(a):
+        for length in range(1, SEGMENTS + 1):
+            if length + 2 >= n:
+                break
+            segment = [tour[(pos[a] + k) % n] for k in range(length)]
+            if depot in segment:
+                break
+            first, last = segment[0], segment[-1]
+            p, q = pred(first), succ(last)
+            removed = dist(p, first) + dist(last, q) - dist(p, q)
+            if removed <= IMPROVEMENT:
+                continue
+            inside = set(segment)
+            for c in neighbors[first] + neighbors[last]:
+                if c in inside:
+                    continue
+                for (u, v) in ((c, succ(c)), (pred(c), c)):
+                    if u in inside or v in inside:
+                        continue
+                    kept = dist(u, v)
+                    straight = dist(u, first) + dist(last, v) - kept
+                    turned = dist(u, last) + dist(first, v) - kept
+                    if removed - min(straight, turned) > IMPROVEMENT:
+                        move(segment, u, turned < straight)
+                        return (p, q, u, v) + tuple(segment)
+        return ()
+
+    def move(segment, u, turned):
+        inside = set(segment)
+        rest = [a for a in tour if a not in inside]
+        at = rest.index(u) + 1
+        rest[at:at] = segment[::-1] if turned else segment
+        tour[:] = rest
+        for (i, a) in enumerate(tour):
+            pos[a] = i
+
+    queue = collections.deque(order)
+    queued = [True] * M + [False]
+    while queue:
+        if deadline is not None and time.time() > deadline:
+            break
+        a = queue.popleft()
+        queued[a] = False
+        changed = two_opt(a) or or_opt(a)
+        for b in changed:
+            if not queued[b] and b != depot:
+                queued[b] = True
+                queue.append(b)
+
+    at = pos[depot]
+    return tour[at + 1:] + tour[:at]
+
+#
+#   The linkage groups: the loci linked directly or through other loci, the connected
+#   components of the graph of the linked pairs. linked(start, stop) gives the
+#   (stop - start x M) bools of the rows of the loci, they are read a block at a time.
+#   The union-find runs on whole arrays of pairs: every root hooks to the smallest root
+#   it is linked to, then the paths are halved, until the pairs have the same roots.
+#   The groups come in the order of their first loci
+#
+def linkage_groups(M, linked, block_rows=256):
+    root = np.arange(M)
+    for start in range(0, M, block_rows):
+        a, b = np.nonzero(linked(start, min(M, start + block_rows)))
+        a += start
+        upper = a < b
+        a, b = a[upper], b[upper]
+        while len(a):
+            root = _flat(root)
+            ra, rb = root[a], root[b]
+            apart = ra != rb
+            a, b, ra, rb = a[apart], b[apart], ra[apart], rb[apart]
+            np.minimum.at(root, np.maximum(ra, rb), np.minimum(ra, rb))
+    root = _flat(root)
+    group = np.unique(root, return_inverse=True)[1]
+    order = np.argsort(group, kind="mergesort")
+    bounds = np.cumsum(np.bincount(group))[:-1]
+    return [g.tolist() for g in np.split(order, bounds)]
+
+# every locus straight to its root
+def _flat(root):
+    while True:
+        up = root[root]
+        if np.array_equal(up, root):
+            return root
+        root = up
+
+#
+#   The order of every group, each one ordered alone: by order_loci with the engine,
+#   or with form_cluster and complete_order for None. With workers > 1 the groups
+#   go to a process pool, the biggest ones first. The matrices with submatrix() give
+#   every group its own one of the same kind, only a dense matrix gives dense squares
+#
+def order_groups(fracs, groups, engine=None, refine=True, time_budget=None, workers=1):
+    fracs = _readable(fracs)
+
+    def task(group):
+        if hasattr(fracs, "submatrix"):
+            return (fracs.submatrix(group), engine, refine, time_budget)
+        return (fracs[np.ix_(group, group)], engine, refine, time_budget)
+
+    if workers > 1 and len(groups) > 1:
+        biggest = sorted(range(len(groups)), key=lambda g: -len(groups[g]))
+        pool = multiprocessing.Pool(workers)
+        try:
+            done = pool.map(_order_group, [task(groups[g]) for g in biggest], chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        orders = [None] * len(groups)
+        for (g, order) in zip(biggest, done):
+            orders[g] = order
+    else:
+        orders = [_order_group(task(group)) for group in groups]
+    return [[group[i] for i in order] for (group, order) in zip(groups, orders)]
+
+def _order_group(task):
+    matrix, engine, refine, time_budget = task
+    if engine is None:
+        return complete_order(form_cluster(len(matrix), matrix), matrix)
+    return order_loci(matrix, engine, refine, time_budget)
@@ -0,0 +1,202 @@
+'''
+    Stage timings and counters of the mapping pipeline
+
+    The code marks its stages and counts what it does:
+
+        with profiling.stage("reveal_gametes"):
+            ...
+        profiling.count("meioses", len(children))
+
+    Both do nothing until a profiler is on:
+
+        with profiling.profile() as profiler:
+            genmap.process_pedigree("file.gen")
+        print(profiler.to_json())
+
+    Every stage gets its number of calls, wall and CPU time and the peak RSS of the process
+    at its end; with trace_memory the memory allocated in it by tracemalloc, or on Python 2
+    the change of the RSS of the process over it; with cprofile_dir a cProfile of it, saved
+    as <stage>.prof. The times of a stage include the ones of the stages inside it. The hooks
+    are called with the record of every finished stage
+'''
+import os
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:             # not on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:             # Python 2
+    tracemalloc = None
+
+try:
+    import cProfile
+except ImportError:
+    import profile as cProfile
+
+_active = None
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+#
+#   The RSS of the process now from /proc, else the peak one; None when neither is there
+#
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError, ValueError, AttributeError):
+        return max_rss_kb()
+
+#
+#   How trace_memory measures the memory of a stage: "tracemalloc", "rss" or None
+#
+def memory_tracer():
+    if tracemalloc is not None:
+        return "tracemalloc"
+    if rss_kb() is not None:
+        return "rss"
+    return None
+
+
+class Profiler(object):
+    def __init__(self, cprofile_dir=None, trace_memory=False, hooks=()):
+        self.cprofile_dir = cprofile_dir
+        self.trace_memory = trace_memory and memory_tracer()
+        if trace_memory and not self.trace_memory:
+            raise ValueError("trace_memory needs tracemalloc or the RSS of the process")
+        self.hooks = list(hooks)
+        self.stages = {}
+        self.order = []
+        self.counters = {}
+        self._depth = 0
+        self._cprofiles = {}
+        self._started_tracing = False
+
+    def start(self):
+        if self.trace_memory == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start = time.time()
+
+    def stop(self):
+        self.wall = time.time() - self._start
+        if self.trace_memory == "tracemalloc":
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+        if self._started_tracing:
+            tracemalloc.stop()
+        if self.cprofile_dir:
+            if not os.path.isdir(self.cprofile_dir):
+                os.makedirs(self.cprofile_dir)
+            for (name, prof) in self._cprofiles.items():
+                path = os.path.join(self.cprofile_dir, "%s.prof" % name)
+                prof.dump_stats(path)
+                self.stages[name]["cprofile"] = path
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # cProfile can profile only one thing at a time, so only the outermost stages
+        prof = None
+        if self.cprofile_dir and self._depth == 0:
+            prof = self._cprofiles.setdefault(name, cProfile.Profile())
+        allocated = tracemalloc.get_traced_memory()[0] if self.trace_memory == "tracemalloc" else None
+        rss = rss_kb() if self.trace_memory == "rss" else None
+        wall, cpu = time.time(), cpu_time()
+        self._depth += 1
+        if prof is not None:
+            prof.enable()
+        try:
+            yield
+        finally:
+            if prof is not None:
+                prof.disable()
+            self._depth -= 1
+            record = {"stage": name, "wall": time.time() - wall, "cpu": cpu_time() - cpu,
+                      "max_rss_kb": max_rss_kb()}
+            if allocated is not None:
+                record["allocated_bytes"] = tracemalloc.get_traced_memory()[0] - allocated
+            if rss is not None:
+                record["rss_change_kb"] = rss_kb() - rss
+            self._add(record)
+
+    def _add(self, record):
+        name = record["stage"]
+        if name not in self.stages:
+            self.order.append(name)
+            self.stages[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0}
+        total = self.stages[name]
+        total["calls"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        total["max_rss_kb"] = record["max_rss_kb"]
+        if "allocated_bytes" in record:
+            total["allocated_bytes"] = total.get("allocated_bytes", 0) + record["allocated_bytes"]
+        if "rss_change_kb" in record:
+            total["rss_change_kb"] = total.get("rss_change_kb", 0) + record["rss_change_kb"]
+        for hook in self.hooks:
+            hook(record)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        report = {"stages": [dict(self.stages[name], stage=name) for name in self.order],
+                  "counters": dict(self.counters),
+                  "max_rss_kb": max_rss_kb()}
+        if hasattr(self, "wall"):
+            report["wall"] = self.wall
+        if hasattr(self, "traced_peak"):
+            report["traced_peak_bytes"] = self.traced_peak
+        return report
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+#
+#   Turn the profiler on for the code in the with block
+#
+@contextlib.contextmanager
+def profile(cprofile_dir=None, trace_memory=False, hooks=()):
+    global _active
+    profiler = Profiler(cprofile_dir, trace_memory, hooks)
+    previous, _active = _active, profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        profiler.stop()
+
+
+def active():
+    return _active is not None
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+
+def stage(name):
+    if _active is None:
+        return _nothing()
+    return _active.stage(name)
+
+
+def count(name, n=1):
+    if _active is not None:
+        _active.count(name, n)
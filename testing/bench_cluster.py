@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+    Time of ordering.form_cluster, the "index" engine against the "python" scan
+
+    usage: bench_cluster.py [--sizes 100 1000 10000] [--python-max 1000] [--seed 0]
+
+    The fractions are drawn like the ones of a real map: loci spread over a few
+    Morgans, recombinations counted over a limited number of meioses, so many
+    fractions are equal. The scan is only timed up to --python-max loci, the
+    clusters of both engines must be the same.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ordering
+
+
+def synthetic_fracs(M, seed, length=3.0, meioses=200):
+    random = np.random.RandomState(seed)
+    positions = np.sort(random.uniform(0, length, M))
+    fracs = np.empty((M, M))
+    for start in range(0, M, 512):
+        distance = np.abs(positions[start:start + 512, None] - positions[None, :])
+        # Haldane
+        fracs[start:start + 512] = random.binomial(meioses, 0.5 * (1 - np.exp(-2 * distance))) / float(meioses)
+    # the cis/trans counts are symmetric
+    upper = np.triu(fracs, 1)
+    return upper + upper.T
+
+
+def timed(f):
+    start = time.time()
+    result = f()
+    return result, time.time() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark form_cluster")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--python-max", type=int, default=1000,
+                        help="largest number of loci to run the python engine for")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print("%8s %12s %12s %10s %8s" % ("loci", "index, s", "python, s", "speedup", "cluster"))
+    for M in args.sizes:
+        fracs = synthetic_fracs(M, args.seed)
+        cluster, index_time = timed(lambda: ordering.form_cluster(M, fracs))
+        if M <= args.python_max:
+            matrix = fracs.tolist()
+            expected, python_time = timed(lambda: ordering.form_cluster(M, matrix, engine="python"))
+            if expected != cluster:
+                sys.exit("the clusters differ for %d loci" % M)
+            print("%8d %12.3f %12.3f %9.1fx %8d"
+                  % (M, index_time, python_time, python_time / index_time, len(cluster)))
+        else:
+            print("%8d %12.3f %12s %10s %8d" % (M, index_time, "-", "-", len(cluster)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
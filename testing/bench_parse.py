@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+    Parse throughput of genfile.read_gen
+
+    usage: bench_parse.py [--scale 100] [--repeat 3] [--reference] [file ...]
+
+    Every file is also replicated --scale times (with shifted ids) into a
+    temporary synthetic pedigree, plain and gzip compressed.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import genfile
+
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets", "o1000m100")
+
+
+def scaled(data, scale):
+    shift = int(data.ids.max()) if len(data.ids) else 0
+    copies = [k * shift for k in range(scale)]
+    parents = np.concatenate([np.where(data.parents != 0, data.parents + s, 0) for s in copies])
+    return genfile.GenData(data.M, data.locs_names,
+                           np.concatenate([data.ids + s for s in copies]),
+                           parents,
+                           np.tile(data.sexes, scale),
+                           np.tile(data.genotypes, (scale, 1)))
+
+#
+#   The old way: one line at a time, a Python int per allel
+#
+def reference_parse(path):
+    with open(path) as f:
+        lines = (l.strip() for l in f)
+        lines = (l for l in lines if l)
+        next(lines)
+        M = int(next(lines))
+        next(lines)
+        next(lines)
+        records = []
+        for _ in range(int(next(lines))):
+            header = [int(x) for x in next(lines).split()]
+            records.append((header, [int(a) for a in next(lines).split()]))
+    return M, records
+
+
+def best_time(f, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(label, path, seconds, organisms):
+    size = os.path.getsize(path) / float(1 << 20)
+    print("%-28s %8.1f MB %8.3f s %8.1f MB/s %10.0f organisms/s"
+          % (label, size, seconds, size / seconds, organisms / seconds))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the .GEN parser")
+    parser.add_argument("files", nargs="*", default=[DEFAULT_FILE])
+    parser.add_argument("--scale", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference", action="store_true",
+                        help="also time the line by line parser")
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix="bench_parse")
+    try:
+        for path in args.files:
+            data = genfile.read_gen(path)
+            name = os.path.basename(path)
+            big = scaled(data, args.scale)
+            big_path = os.path.join(tmp, "%s.x%d" % (name, args.scale))
+            genfile.write_gen(big_path, big)
+            genfile.write_gen(big_path + ".gz", big)
+
+            for (label, p, n) in [(name, path, len(data.ids)),
+                                  ("%s x%d" % (name, args.scale), big_path, len(big.ids)),
+                                  ("%s x%d .gz" % (name, args.scale), big_path + ".gz", len(big.ids))]:
+                report(label, p, best_time(lambda: genfile.read_gen(p), args.repeat), n)
+                if args.reference and not p.endswith(".gz"):
+                    report(label + " (reference)", p, best_time(lambda: reference_parse(p), 1), n)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
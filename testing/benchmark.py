@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''
+    Stage timings of the mapping pipeline, with a history to catch regressions
+
+    usage: benchmark.py [--datasets NAME ...] [--synthetic 2000x200[:SEED] ...]
+                        [--engine numpy] [--repeat 3] [--history FILE]
+                        [--threshold 0.25] [--no-record]
+           benchmark.py --batch [--workers 2] [--engine numpy] [--repeat 3] [PATH ...]
+
+    Every dataset runs in its own process, a number of times, and the best time
+    of every stage is kept:
+          parse           - genfile.read_gen
+          pedigree        - Pedigree.from_arrays, the gametes revealed included
+          reveal_gametes  - reveal_gametes once more on the built pedigree
+          cistrans        - count_cistrans, the condensed counts of all the parents
+          fracs           - fraction_matrix of the counts
+          form_cluster    - ordering.form_cluster
+    along with the peak RSS of the process. The synthetic datasets come from
+    pedigree_generator.py with a fixed seed. The results are compared with the
+    last run in the history of the same dataset and engine: the benchmark fails
+    when a stage got slower by more than --threshold.
+
+    --batch times the whole mapping of the files (testing/datasets by default)
+    with "genmap.py batch" against one genmap.py process per file.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+DATASETS = os.path.join(HERE, "datasets")
+DEFAULT_DATASETS = ["o200m30", "o200m40", "o200m50", "o300m30", "o300m40", "o300m50",
+                    "o400m30", "o400m40", "o400m50", "o1000m100"]
+DEFAULT_SYNTHETIC = ["2000x200:1", "5000x300:1"]
+# a local file, kept out of git by .gitignore
+DEFAULT_HISTORY = os.path.join(HERE, "bench_history.json")
+STAGES = ["parse", "pedigree", "reveal_gametes", "cistrans", "fracs", "form_cluster"]
+# differences below this many seconds are noise
+MIN_SLOWDOWN = 0.005
+
+
+def peak_rss_kb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+#
+#   The stages on one file, in this process. The result goes to stdout as JSON
+#
+def run_stages(path, engine):
+    import genfile
+    import genmap
+    import ordering
+
+    times = {}
+
+    def stage(name, f):
+        start = time.time()
+        result = f()
+        times[name] = time.time() - start
+        return result
+
+    data = stage("parse", lambda: genfile.read_gen(path))
+    pedigree = stage("pedigree", lambda: genmap.Pedigree.from_arrays(
+        data.M, data.locs_names, data.ids, data.parents, data.sexes, data.genotypes))
+    stage("reveal_gametes", pedigree.reveal_gametes)
+    counts = stage("cistrans", lambda: pedigree.count_cistrans(pedigree.parent_rows(), engine=engine))
+    fracs = stage("fracs", lambda: genmap.fraction_matrix(counts[0], counts[1]))
+    stage("form_cluster", lambda: ordering.form_cluster(data.M, fracs))
+    return {"stages": times, "peak_rss_kb": peak_rss_kb(),
+            "organisms": len(data.ids), "loci": data.M}
+
+
+def measure(path, engine, repeat):
+    best = None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       "--run-stages", path, "--engine", engine])
+        run = json.loads(out.decode("ascii"))
+        if best is None:
+            best = run
+        else:
+            for name in STAGES:
+                best["stages"][name] = min(best["stages"][name], run["stages"][name])
+            best["peak_rss_kb"] = max(best["peak_rss_kb"], run["peak_rss_kb"])
+    return best
+
+#
+#   "2000x200:7" - 2000 organisms with 200 markers, seed 7
+#
+def synthetic(spec, directory):
+    size, _, seed = spec.partition(":")
+    organisms, markers = [int(x) for x in size.split("x")]
+    seed = int(seed or 1)
+    path = os.path.join(directory, "synthetic_%dx%d_%d.gen" % (organisms, markers, seed))
+    with open(path, "w") as f:
+        subprocess.check_call([sys.executable, os.path.join(HERE, "pedigree_generator.py"),
+                               str(organisms), str(markers), str(seed)], stdout=f)
+    return "%dx%d:%d" % (organisms, markers, seed), path
+
+
+#
+#   Best wall times of "genmap.py batch" on the paths and of one genmap.py per file
+#
+def measure_batch(paths, engine, workers, repeat):
+    import genmap
+    genmap_py = os.path.join(HERE, "..", "genmap.py")
+    files = genmap.batch_files(paths)
+    devnull = open(os.devnull, "w")
+
+    def best(commands):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            for command in commands:
+                subprocess.check_call(command, stdout=devnull)
+            times.append(time.time() - start)
+        return min(times)
+
+    batch = best([[sys.executable, genmap_py, "batch", "--engine", engine,
+                   "--workers", str(workers)] + files])
+    single = best([[sys.executable, genmap_py, "--engine", engine, path] for path in files])
+    print("%d files: batch %.3fs, a process per file %.3fs" % (len(files), batch, single))
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                      stderr=open(os.devnull, "w"))
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_history(path, history):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+#
+#   The stages that got slower than in the last run of the same dataset and engine
+#
+def regressions(history, run, threshold):
+    slower = []
+    for (name, result) in sorted(run["results"].items()):
+        previous = [r for r in history if r["engine"] == run["engine"] and name in r["results"]]
+        if not previous:
+            continue
+        last = previous[-1]
+        for stage in STAGES:
+            before = last["results"][name]["stages"][stage]
+            now = result["stages"][stage]
+            if now > before * (1 + threshold) and now - before > MIN_SLOWDOWN:
+                slower.append((name, stage, last, before, now))
+    return slower
+
+
+def report(run):
+    print("%-24s" % "dataset" + "".join("%15s" % s for s in STAGES) + "%12s" % "peak RSS")
+    for (name, result) in sorted(run["results"].items()):
+        print("%-24s" % name
+              + "".join("%14.4fs" % result["stages"][s] for s in STAGES)
+              + "%10.1fMB" % (result["peak_rss_kb"] / 1024.0))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the mapping stages")
+    parser.add_argument("--datasets", nargs="*", default=DEFAULT_DATASETS,
+                        help="names in testing/datasets or paths")
+    parser.add_argument("--synthetic", nargs="*", default=DEFAULT_SYNTHETIC,
+                        metavar="ORGANISMSxMARKERS[:SEED]")
+    parser.add_argument("--engine", default="numpy", help="cis/trans counting engine")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--history", default=DEFAULT_HISTORY,
+                        help="JSON file of the runs, testing/bench_history.json by default")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown of a stage, 0.25 is 25%%")
+    parser.add_argument("--no-record", dest="record", action="store_false",
+                        help="only compare, do not add the run to the history")
+    parser.add_argument("--batch", nargs="*", metavar="PATH",
+                        help="time genmap.py batch on the files or directories, testing/datasets by default")
+    parser.add_argument("--workers", type=int, default=1, help="processes of --batch")
+    parser.add_argument("--run-stages", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.batch is not None:
+        measure_batch(args.batch or [DATASETS], args.engine, args.workers, args.repeat)
+        return 0
+
+    if args.run_stages:
+        print(json.dumps(run_stages(args.run_stages, args.engine)))
+        return 0
+
+    run = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+           "host": socket.gethostname(), "python": platform.python_version(),
+           "engine": args.engine, "repeat": args.repeat, "results": {}}
+    tmp = tempfile.mkdtemp(prefix="genmap_benchmark")
+    try:
+        paths = [(name, name if os.path.exists(name) else os.path.join(DATASETS, name))
+                 for name in args.datasets]
+        paths += [synthetic(spec, tmp) for spec in args.synthetic]
+        for (name, path) in paths:
+            run["results"][name] = measure(path, args.engine, args.repeat)
+    finally:
+        shutil.rmtree(tmp)
+
+    report(run)
+    history = load_history(args.history)
+    slower = regressions(history, run, args.threshold)
+    for (name, stage, last, before, now) in slower:
+        print("SLOWER: %s %s %.4fs -> %.4fs (+%.0f%%) since %s (%s)"
+              % (name, stage, before, now, 100 * (now / before - 1), last["time"], last["commit"]))
+    if args.record:
+        history.append(run)
+        save_history(args.history, history)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+'''
+    CistransAccumulator on a pedigree mapped from its binary file
+
+    usage: check_accumulator.py [DATASET] [--changes 20] [--seed 0]
+
+    The dataset (testing/datasets/o200m30 by default) is converted to a binary
+    pedigree file in a temporary directory and loaded from it, so its arrays are
+    read-only. The genotypes of random organisms are changed with update_genotype,
+    after every change the counts of the accumulator must be the ones counted again
+    from the start on a pedigree read from the .GEN file with the same changes.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import genmap
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Check CistransAccumulator on a binary pedigree")
+    parser.add_argument("dataset", nargs="?", default=os.path.join(HERE, "datasets", "o200m30"))
+    parser.add_argument("--changes", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    random = np.random.RandomState(args.seed)
+    tmp = tempfile.mkdtemp(prefix="check_accumulator")
+    try:
+        binary = os.path.join(tmp, os.path.basename(args.dataset) + genmap.BINARY_SUFFIX)
+        genmap.convert(args.dataset, binary)
+        mapped = genmap.load_pedigree(binary)
+        reference = genmap.open_file(args.dataset)
+        accumulator = genmap.CistransAccumulator(mapped)
+        for _ in range(args.changes):
+            # the row update_genotype finds, the ids of the datasets repeat
+            id = int(reference.ids[random.randint(len(reference.ids))])
+            o = int(reference.rows_of([id])[0])
+            allels = random.randint(0, 3, 2 * reference.M).astype(np.int8)
+            accumulator.update_genotype(id, allels)
+            reference.set_genotype(o, allels)
+            reference.reveal_gametes()
+            rec, nonrec, _ = reference.count_cistrans(reference.parent_rows())
+            if not ((np.asarray(accumulator.rec) == np.asarray(rec)).all()
+                    and (np.asarray(accumulator.nonrec) == np.asarray(nonrec)).all()):
+                print("the counts differ after the change of organism %d" % id)
+                return 1
+    finally:
+        shutil.rmtree(tmp)
+    print("%d changes, the counts are right" % args.changes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
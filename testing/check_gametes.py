@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+    Pedigree.reveal_gametes against the per-organism loop it replaced
+
+    usage: check_gametes.py [DATASET ...] [--organisms 600] [--markers 150]
+                            [--missing 0.2] [--orphans 0.1] [--block-rows 64] [--seed 0]
+
+    The gametes of every organism are revealed again one organism and one locus at a time,
+    with the rules of the original object code and the parent of a gamete in its last slot.
+    The 31.05.13 rule gives the first gamete to the first parent and the second one to the
+    second, whether a locus told it or not. gamets1, gamets2 and gamete_parents must give
+    the same lists on every dataset (all of testing/datasets by default) and on a pedigree
+    of pedigree_generator with --missing genotypes and --orphans children of one parent.
+    The gametes are revealed block_rows organisms at a time, so the blocks meet inside them
+'''
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import genmap
+import pedigree_generator
+
+#
+#   The two gametes of the organism s as lists, M allels and the id of the parent
+#
+def reference_gametes(s, M):
+    allels = s.allels
+    g1 = [0] * (M + 1)
+    g2 = [0] * (M + 1)
+    for i in range(M):
+        if allels[2 * i] == allels[2 * i + 1]:
+            g1[i] = g2[i] = allels[2 * i]
+    parents = s.parents
+    if not parents:
+        return g1, g2
+
+    p = parents[0]
+    p_allels = p.allels
+    m_allels = parents[1].allels if len(parents) == 2 else None
+    for i in range(M):
+        if g1[i] != 0:                          # the organism is homozygota here
+            continue
+        if p_allels[2 * i] == p_allels[2 * i + 1] and p_allels[2 * i] != 0:
+            g1[i] = p_allels[2 * i]
+            g1[M] = p.id
+            g2[i] = 3 - p_allels[2 * i]
+            if len(parents) == 2:
+                g2[M] = parents[1].id
+        elif m_allels is not None and m_allels[2 * i] == m_allels[2 * i + 1] and m_allels[2 * i] != 0:
+            g2[i] = m_allels[2 * i]
+            g2[M] = parents[1].id
+            g1[i] = 3 - m_allels[2 * i]
+            g1[M] = p.id
+    # 31.05.13
+    if g1[M] == 0:
+        g1[M] = p.id
+    if g2[M] == 0 and len(parents) == 2:
+        g2[M] = parents[1].id
+    return g1, g2
+
+#
+#   The id of the first organism of the pedigree with other gametes than the reference, or None
+#
+def first_difference(pedigree, block_rows):
+    pedigree.reveal_gametes(block_rows=block_rows)
+    for s in pedigree.organisms:
+        if (pedigree.gamete(s.index, 0), pedigree.gamete(s.index, 1)) != reference_gametes(s, pedigree.M):
+            return s.id
+    return None
+
+#
+#   A pedigree of pedigree_generator, the orphans part of the children left with one parent
+#
+def simulated_pedigree(args):
+    random = np.random.RandomState(args.seed)
+    fractions = pedigree_generator.random_map(args.markers, 1.0, random)
+    data = pedigree_generator.simulate(args.organisms, fractions, missing=args.missing,
+                                       seed=random.randint(2 ** 31))
+    parents = data.parents.copy()
+    orphans = (parents != 0).all(axis=1) & (random.random_sample(len(parents)) < args.orphans)
+    parents[orphans, random.randint(0, 2, len(parents))[orphans]] = 0
+    return genmap.Pedigree.from_arrays(data.M, data.locs_names, data.ids, parents, data.sexes,
+                                       data.genotypes)
+
+
+def main(argv):
+    datasets = os.path.join(HERE, "datasets")
+    parser = argparse.ArgumentParser(description="Check the gametes of Pedigree.reveal_gametes")
+    parser.add_argument("datasets", nargs="*",
+                        default=[os.path.join(datasets, name) for name in sorted(os.listdir(datasets))
+                                 if "." not in name])
+    parser.add_argument("--organisms", type=int, default=600)
+    parser.add_argument("--markers", type=int, default=150)
+    parser.add_argument("--missing", type=float, default=0.2)
+    parser.add_argument("--orphans", type=float, default=0.1)
+    parser.add_argument("--block-rows", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    pedigrees = [(path, lambda path=path: genmap.open_file(path)) for path in args.datasets]
+    pedigrees.append(("simulated", lambda: simulated_pedigree(args)))
+    organisms = 0
+    for (name, load) in pedigrees:
+        pedigree = load()
+        id = first_difference(pedigree, args.block_rows)
+        if id is not None:
+            print("%s: the gametes of organism %d differ" % (name, id))
+            return 1
+        organisms += len(pedigree.ids)
+    print("%d pedigrees, %d organisms, the gametes are right" % (len(pedigrees), organisms))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
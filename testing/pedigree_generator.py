@@ -1,105 +1,205 @@
-#!/usr/bin/env python3
-
-import random
-import textwrap
-
-MALE = "male"
-FEMALE = "female"
-
-class Organism(object):
-    def __init__(self, id, sex, allels=None, mother=None, father=None):
-        self.id = id
-        self.sex = sex
-        self.mother = mother
-        self.father = father
-        self.allels = allels
-
-    def __str__(self):
-        return "Organism: id={id}".format(id=self.id)
-
-
-def generate(n_parents, n_generations, n_children, cis_fraction=.5, n_allels=100):
-    parents = generate_parents(n_parents, n_allels)
-    children = cross(parents, n_generations, n_children)
-    orgamisms = parents + children
-    random.shuffle(orgamisms)
-    return orgamisms
-
-
-def generate_parents(n, n_allels):
-    def random_parent(id):
-        allels = [(random.choice([1, 2]), random.choice([1, 2]))
-                  for _ in range(n_allels)]
-        sex = random.choice([MALE, FEMALE])
-        return Organism(id, sex, allels)
-
-    return [random_parent(id) for id in range(1, n + 1)]
-
-
-def cross(parents, n_generations, n_children):
-    def cross_pair(id, m, f):
-        assert len(m.allels) == len(f.allels), "Incompatible parents"
-        sex = random.choice([MALE, FEMALE])
-        mi = random.choice([0, 1])
-        fi = random.choice([0, 1])
-        allels = []
-        for (m_a, f_a) in zip(m.allels, f.allels):
-            if random.random() < 0.35:
-                mi = random.choice([0, 1])
-                fi = random.choice([0, 1])
-            allels.append((m_a[mi], f_a[fi]))
-            org = Organism(id, sex, allels, m, f)
-
-        return org
-
-    population = parents
-    for gen in range(n_generations):
-        start_id = max(x.id for x in population) + 1
-        children_ids = range(start_id, start_id + n_children)
-        mothers = [m for m in population if m.sex == FEMALE]
-        fathers = [f for f in population if f.sex == MALE]
-        assert mothers and fathers, "All parents have the same sex"
-        children = [cross_pair(id,
-                               random.choice(mothers),
-                               random.choice(fathers))
-                    for id in children_ids]
-        population += children
-
-
-    return population
-
-def print_organisms(orgamisms):
-
-    def get_header():
-        n_allels = len(orgamisms[0].allels)
-        return "1\n{n_allels}\n{allel_names}\n\n1\n{n_orgnisms}\n".format(
-            n_allels=n_allels,
-            allel_names=" ".join( "L{}".format(i) for i in range(n_allels) ),
-            n_orgnisms=len(orgamisms)
-        )
-
-    def format_allels(allels):
-        return " ".join("{} {}".format(a, b) for (a, b) in allels)
-
-    print(get_header(), end='')
-    for o in orgamisms:
-        s = "{id} {mother} {father} {sex} \n{allels}\n".format(
-            id=o.id,
-            mother=o.mother.id if o.mother else 0,
-            father=o.father.id if o.father else 0,
-            sex={MALE: 0, FEMALE: 1}[o.sex],
-            allels=format_allels(o.allels)
-        )
-        print(s, end='')
-
-
-if __name__=="__main__":
-    import sys
-    n_organisms, n_markers = [int(x) for x in sys.argv[1:]]
-    n_generations = 5
-    n_children = int(n_organisms / n_generations)
-    organisms = generate(
-        n_parents=3, n_generations=n_generations,
-        n_children=n_children, n_allels=n_markers)
-
-    print_organisms(organisms)
+#!/usr/bin/env python
+'''
+    Synthetic pedigrees with a known order of the loci
+
+    usage: pedigree_generator.py ORGANISMS MARKERS [SEED] [options] > file.gen
+
+    A few founders with random genotypes, then generations of children of random
+    mothers and fathers from all the organisms so far. Every meiosis follows the
+    genetic map: a crossover in the interval between the neighbor loci i and i+1
+    happens with the probability fractions[i]. The map is random, the loci spread
+    uniformly over --length Morgans, unless --map gives the fractions or
+    --fraction makes them all the same. The loci are named L0, L1, ... in the order
+    of the map; --shuffle-loci writes them in a random order, --true-order saves
+    the map order with the positions.
+
+    The meioses of a block of children are simulated at once: the crossovers come
+    from geometric jumps over the intervals, so finding them takes time in their
+    number, not in the number of intervals. The .GEN file is written in blocks (gzip compressed
+    for a name ending with .gz); --binary writes the binary pedigree of genmap
+    instead, that one needs Python 2 like genmap itself.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import genfile
+
+MALE = 0
+FEMALE = 1
+
+BLOCK_CHILDREN = 4096
+# the genotypes of a bigger pedigree are kept in a temporary file
+MEMORY_LIMIT = 1 << 30
+
+#
+#   Fractions between the neighbor loci of M loci spread uniformly over length Morgans (Haldane)
+#
+def random_map(M, length, random):
+    positions = np.sort(random.uniform(0, length, M))
+    return 0.5 * (1 - np.exp(-2 * np.diff(positions)))
+
+# positions in Morgans of the loci of the map, the first one at 0
+def map_positions(fractions):
+    fractions = np.minimum(fractions, 0.5 - 1e-12)
+    return np.concatenate([[0.0], np.cumsum(-0.5 * np.log(1 - 2 * fractions))])
+
+#
+#   Which of the two haplotypes every meiosis passes at every locus: (meioses x M) of 0/1.
+#   The crossovers are thinned from the geometric jumps with the largest fraction,
+#   then every run of loci between them is filled at once
+#
+def meioses(n, fractions, random):
+    M = len(fractions) + 1
+    strand = random.randint(0, 2, n)
+    top = fractions.max() if len(fractions) else 0
+    # the loci where the runs start, the first one of every meiosis included
+    rows_started = [np.arange(n)]
+    loci_started = [np.zeros(n, dtype=np.int64)]
+    if top > 0:
+        rows = np.arange(n)
+        interval = np.full(n, -1, dtype=np.int64)
+        while len(rows):
+            interval = interval + random.geometric(top, len(rows))
+            inside = interval < M - 1
+            rows, interval = rows[inside], interval[inside]
+            crossed = random.random_sample(len(rows)) * top < fractions[interval]
+            rows_started.append(rows[crossed])
+            loci_started.append(interval[crossed] + 1)
+    rows = np.concatenate(rows_started)
+    loci = np.concatenate(loci_started)
+    order = np.lexsort((loci, rows))
+    rows, loci = rows[order], loci[order]
+    # the runs of a meiosis take the two haplotypes in turn
+    run = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    values = ((strand[rows] + run) & 1).astype(np.int8)
+    lengths = np.diff(np.append(rows * M + loci, n * M))
+    return np.repeat(values, lengths).reshape(n, M)
+
+# the founders and the children of every generation
+def pedigree_size(n_organisms, founders, generations):
+    if founders < 2:
+        raise ValueError("at least two founders are needed, a male and a female")
+    n_children = max(0, n_organisms - founders) // max(1, generations)
+    return founders, n_children
+
+#
+#   The pedigree as genfile.GenData, the organisms in the order of their generations.
+#   The genotypes go to the given (organisms x 2M) int8 array, a new one by default
+#
+def simulate(n_organisms, fractions, founders=3, generations=5, missing=0.0, seed=None,
+             shuffle_loci=False, genotypes=None):
+    random = np.random.RandomState(seed)
+    M = len(fractions) + 1
+    founders, n_children = pedigree_size(n_organisms, founders, generations)
+    n = founders + generations * n_children
+    if genotypes is None:
+        genotypes = np.empty((n, 2 * M), dtype=np.int8)
+    allels = genotypes.reshape(n, M, 2)
+
+    ids = np.arange(1, n + 1, dtype=np.int64)
+    parents = np.zeros((n, 2), dtype=np.int64)
+    sexes = random.randint(0, 2, n).astype(np.int8)
+    sexes[:2] = [MALE, FEMALE]
+    allels[:founders] = random.randint(1, 3, (founders, M, 2))
+
+    for g in range(generations):
+        born = founders + g * n_children
+        mothers = np.flatnonzero(sexes[:born] == FEMALE)
+        fathers = np.flatnonzero(sexes[:born] == MALE)
+        for start in range(born, born + n_children, BLOCK_CHILDREN):
+            stop = min(born + n_children, start + BLOCK_CHILDREN)
+            mother = mothers[random.randint(0, len(mothers), stop - start)]
+            father = fathers[random.randint(0, len(fathers), stop - start)]
+            parents[start:stop] = ids[np.column_stack([mother, father])]
+            # the first allel from the mother, the second one from the father
+            for (k, parent) in enumerate([mother, father]):
+                strand = meioses(stop - start, fractions, random)
+                parent_allels = allels[parent]
+                allels[start:stop, :, k] = np.where(strand == 1, parent_allels[:, :, 1],
+                                                    parent_allels[:, :, 0])
+
+    if missing > 0:
+        for start in range(0, n, BLOCK_CHILDREN):
+            block = allels[start:start + BLOCK_CHILDREN]
+            block[random.random_sample(block.shape[:2]) < missing] = 0
+
+    names = ["L%d" % i for i in range(M)]
+    if shuffle_loci:
+        columns = random.permutation(M)
+        for start in range(0, n, BLOCK_CHILDREN):
+            block = allels[start:start + BLOCK_CHILDREN]
+            block[:] = block[:, columns]
+        names = [names[i] for i in columns]
+    return genfile.GenData(M, names, ids, parents, sexes, genotypes)
+
+
+def write_binary(path, data):
+    import genmap
+    pedigree = genmap.Pedigree.from_arrays(data.M, data.locs_names, data.ids, data.parents,
+                                           data.sexes, data.genotypes)
+    genfile.write_binary(path, pedigree.M, pedigree.locs_names, pedigree.columns())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Generate a synthetic pedigree")
+    parser.add_argument("organisms", type=int)
+    parser.add_argument("markers", type=int)
+    parser.add_argument("seed", type=int, nargs="?")
+    parser.add_argument("-o", "--output", help=".GEN file, stdout by default")
+    parser.add_argument("--binary", action="store_true", help="write the binary pedigree file")
+    parser.add_argument("--founders", type=int, default=3)
+    parser.add_argument("--generations", type=int, default=5)
+    parser.add_argument("--length", type=float, default=1.0, help="length of the map in Morgans")
+    parser.add_argument("--fraction", type=float, help="the same fraction between all the neighbor loci")
+    parser.add_argument("--map", help="file with the MARKERS-1 fractions between the neighbor loci")
+    parser.add_argument("--missing", type=float, default=0.0, help="part of the genotypes left unknown")
+    parser.add_argument("--shuffle-loci", action="store_true", help="write the loci in a random order")
+    parser.add_argument("--true-order", help="write the loci in the map order with the positions (cM) here")
+    args = parser.parse_args(argv)
+    if args.binary and not args.output:
+        parser.error("--binary needs --output")
+
+    random = np.random.RandomState(args.seed)
+    if args.map:
+        with open(args.map) as f:
+            fractions = np.array(f.read().split(), dtype=np.float64)
+        if len(fractions) != args.markers - 1:
+            parser.error("%s has %d fractions, not %d" % (args.map, len(fractions), args.markers - 1))
+    elif args.fraction is not None:
+        fractions = np.full(args.markers - 1, args.fraction)
+    else:
+        fractions = random_map(args.markers, args.length, random)
+
+    founders, n_children = pedigree_size(args.organisms, args.founders, args.generations)
+    n = founders + args.generations * n_children
+    tmp = None
+    genotypes = None
+    if n * 2 * args.markers > MEMORY_LIMIT:
+        tmp = tempfile.NamedTemporaryFile(prefix="pedigree_generator")
+        genotypes = np.memmap(tmp, dtype=np.int8, mode="w+", shape=(n, 2 * args.markers))
+    try:
+        data = simulate(args.organisms, fractions, args.founders, args.generations, args.missing,
+                        random.randint(2 ** 31), args.shuffle_loci, genotypes)
+        if args.true_order:
+            with open(args.true_order, "w") as f:
+                for (i, position) in enumerate(map_positions(fractions)):
+                    f.write("L%d %.6f\n" % (i, 100 * position))
+        if args.binary:
+            write_binary(args.output, data)
+        else:
+            genfile.write_gen(args.output or getattr(sys.stdout, "buffer", sys.stdout), data)
+    finally:
+        if tmp is not None:
+            del genotypes
+            tmp.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])